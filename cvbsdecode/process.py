@@ -7,6 +7,7 @@ import itertools
 
 import lddecode.core as ldd
 import lddecode.utils as lddu
+import lddecode.fft_service as npfft
 from lddecode.utils import inrange
 from vhsdecode.utils import get_line
 
@@ -16,16 +17,6 @@ from vhsdecode.addons.chromasep import ChromaSepClass
 # from vhsdecode.process import getpulses_override as vhs_getpulses_override
 # from vhsdecode.addons.vsyncserration import VsyncSerration
 
-# Use PyFFTW's faster FFT implementation if available
-try:
-    import pyfftw.interfaces.numpy_fft as npfft
-    import pyfftw.interfaces
-
-    pyfftw.interfaces.cache.enable()
-    pyfftw.interfaces.cache.set_keepalive_time(10)
-except ImportError:
-    import numpy.fft as npfft
-
 
 def chroma_to_u16(chroma):
     """Scale the chroma output array to a 16-bit value for output."""
@@ -517,7 +508,13 @@ class CVBSDecode(ldd.LDdecode):
             raise Exception("Unknown video system!", system)
 
         self.demodcache = ldd.DemodCache(
-            self.rf, self.infile, self.freader, num_worker_threads=self.numthreads
+            self.rf,
+            self.infile,
+            self.freader,
+            num_worker_threads=self.numthreads,
+            cache_mb=extra_options.get("cache_mb"),
+            demod_cache=extra_options.get("demod_cache"),
+            backend=extra_options.get("backend", "process"),
         )
 
     # Override to avoid NaN in JSON.
@@ -662,8 +659,11 @@ class VHSDecodeInner(ldd.RFDecode):
         self.delays["video_sync"] = 0
         self.delays["video_white"] = 0
 
+    def demodblocks(self, fftdata, mtf_level=0, cut=False):
+        return [self.demodblock(fftdata=f, mtf_level=mtf_level, cut=cut) for f in fftdata]
+
     def demodblock(self, data=None, mtf_level=0, fftdata=None, cut=False):
-        data = npfft.ifft(fftdata).real
+        data = npfft.irfft(fftdata, self.blocklen)
 
         rv = {}
 
@@ -45,6 +45,10 @@ static AVPacket *pkt = NULL;
 
 static uint64_t seekto = 0;
 
+// When started from an indexed Ogg page, the sample # of the next decoded
+// sample.  Timestamps aren't reliable after a byte seek, so count instead.
+static int64_t position = -1;
+
 static int decode_packet(AVCodecContext *dec, const AVPacket *pkt)
 {
     int ret = 0;
@@ -69,17 +73,24 @@ static int decode_packet(AVCodecContext *dec, const AVPacket *pkt)
             return ret;
         }
 
+        int64_t frame_start = frame->pts;
+        if (position >= 0) {
+            frame_start = position;
+            position += frame->nb_samples;
+        }
+
         // If we haven't reached the start position, don't output anything
-        if ((frame->pts + frame->nb_samples) < seekto) {
+        if ((frame_start + frame->nb_samples) <= (int64_t)seekto) {
             av_frame_unref(frame);
             continue;
         }
 
         // Write the raw audio data samples to stdout, skipping any data that's
         // before the start position
-        int64_t offset = FFMIN((seekto - frame->pts), 0);
-        size_t unpadded_linesize = frame->nb_samples * av_get_bytes_per_sample(frame->format);
-        size_t rv = write(1, frame->extended_data[0] + (offset * av_get_bytes_per_sample(frame->format)), unpadded_linesize);
+        int64_t offset = FFMAX(((int64_t)seekto - frame_start), 0);
+        size_t sample_bytes = av_get_bytes_per_sample(frame->format);
+        size_t unpadded_linesize = (frame->nb_samples - offset) * sample_bytes;
+        size_t rv = write(1, frame->extended_data[0] + (offset * sample_bytes), unpadded_linesize);
         if (rv != unpadded_linesize) {
             fprintf(stderr, "write error %ld", offset);
             return -1;
@@ -148,8 +159,10 @@ int main (int argc, char **argv)
 {
     int ret = 0;
 
-    if (argc != 2 && argc != 3) {
-        fprintf(stderr, "usage: %s input_file [start_offset_in_samples]\n",
+    int64_t page_offset = -1;
+
+    if (argc != 2 && argc != 3 && argc != 5) {
+        fprintf(stderr, "usage: %s input_file [start_offset_in_samples [page_byte_offset page_first_sample]]\n",
                 argv[0]);
         exit(1);
     }
@@ -158,6 +171,11 @@ int main (int argc, char **argv)
     if (argc >= 3) {
         seekto = atoll(argv[2]);
     }
+    if (argc >= 5) {
+        // Start decoding at an Ogg page found by the .idx sidecar
+        page_offset = atoll(argv[3]);
+        position = atoll(argv[4]);
+    }
 
 #if LIBAVFORMAT_VERSION_MAJOR < 59
     av_register_all();
@@ -214,7 +232,13 @@ int main (int argc, char **argv)
         goto end;
     }
 
-    if (seekto) {
+    if (page_offset > 0) {
+        if (avformat_seek_file(fmt_ctx, -1, page_offset, page_offset, page_offset, AVSEEK_FLAG_BYTE) < 0) {
+            fprintf(stderr, "Could not seek to byte offset %ld\n", page_offset);
+            ret = 1;
+            goto end;
+        }
+    } else if (seekto) {
         uint64_t seeksec = seekto / audio_dec_ctx->sample_rate;
 
         avformat_seek_file(fmt_ctx, -1, (seeksec - 1) * 1000000, seeksec * 1000000, seeksec * 1000000, AVSEEK_FLAG_ANY);
@@ -16,16 +16,6 @@ import numpy as np
 import scipy.signal as sps
 import scipy.interpolate as spi
 
-# Use PyFFTW's faster FFT implementation if available
-try:
-    import pyfftw.interfaces.numpy_fft as npfft
-    import pyfftw.interfaces
-
-    pyfftw.interfaces.cache.enable()
-    pyfftw.interfaces.cache.set_keepalive_time(10)
-except ImportError:
-    import numpy.fft as npfft
-
 # internal libraries
 
 # XXX: figure out how to handle these module imports better for vscode imports
@@ -34,6 +24,12 @@ try:
 except ImportError:
     from lddecode import efm_pll
 
+# FFTs (using PyFFTW if available) come from fft_service
+try:
+    import fft_service as npfft
+except ImportError:
+    from lddecode import fft_service as npfft
+
 try:
     import core
 except ImportError:
@@ -236,7 +232,7 @@ class AudioRF:
     def process_stage1(self, fft_in):
         ''' Apply first state audio filters '''
         a1 = npfft.ifft(self.slicer(fft_in) * self.filt1)
-        a1u = utils.unwrap_hilbert(a1, self.a1_freq)
+        a1u = utils.fm_discriminate(a1, self.a1_freq)
         a1u = a1u[self.audio1_clip:]
 
         return self.audio1_buffer.add(a1u)
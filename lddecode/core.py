@@ -1,5 +1,12 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import copy
+import hashlib
 import itertools
+import json
+import math
+import os
+import queue
 import sys
 import threading
 import time
@@ -12,16 +19,6 @@ import scipy.signal as sps
 import scipy.interpolate as spi
 
 
-# Use PyFFTW's faster FFT implementation if available
-try:
-    import pyfftw.interfaces.numpy_fft as npfft
-    import pyfftw.interfaces
-
-    pyfftw.interfaces.cache.enable()
-    pyfftw.interfaces.cache.set_keepalive_time(10)
-except ImportError:
-    import numpy.fft as npfft
-
 # internal libraries
 
 # XXX: figure out how to handle these module imports better for vscode imports
@@ -30,6 +27,12 @@ try:
 except ImportError:
     from lddecode import efm_pll
 
+# FFTs (using PyFFTW if available) come from fft_service
+try:
+    import fft_service as npfft
+except ImportError:
+    from lddecode import fft_service as npfft
+
 try:
     from utils import *
 except ImportError:
@@ -263,6 +266,19 @@ class RFDecode:
 
     """
 
+    # Every output demodblock can produce.  Only the ones in demod_products
+    # are computed, so users set that to what they actually need.  Others can
+    # be asked for with DemodCache.read()'s products argument.
+    DEMOD_PRODUCTS = (
+        "demod",
+        "demod_raw",
+        "demod_hpf",
+        "demod_05",
+        "demod_burst",
+        "demod_pilot",
+        "rfhpf",
+    )
+
     def __init__(
         self,
         inputfreq=40,
@@ -286,6 +302,7 @@ class RFDecode:
           - PAL_V4300D_NotchFilter - cut 8.5mhz spurious signal
           - NTSC_ColorNotchFilter:  notch filter on decoded video to reduce color 'wobble'
           - lowband: Substitute different decode settings for lower-bandwidth disks
+          - mtf_mult, mtf_offset: MTF compensation multiplier and offset
 
         """
 
@@ -304,8 +321,8 @@ class RFDecode:
         self.freq_hz = self.freq * 1000000
         self.freq_hz_half = self.freq_hz / 2
 
-        self.mtf_mult = 1.0
-        self.mtf_offset = 0
+        self.mtf_mult = extra_options.get("mtf_mult", 1.0)
+        self.mtf_offset = extra_options.get("mtf_offset", 0)
 
         if system == "NTSC":
             self.SysParams = copy.deepcopy(SysParams_NTSC)
@@ -342,6 +359,11 @@ class RFDecode:
         self.decode_digital_audio = decode_digital_audio
         self.decode_analog_audio = decode_analog_audio
 
+        self.demod_products = set(self.DEMOD_PRODUCTS)
+
+        # Plan the block-sized FFTs up front
+        npfft.prepare([self.blocklen])
+
         self.computefilters()
 
         # The 0.5mhz filter is rolled back to align with the data, so there
@@ -351,16 +373,22 @@ class RFDecode:
     def computefilters(self):
         """ (re)compute the filter sets """
 
-        self.computevideofilters()
+        # DemodCache's thread backend may be demodulating with the current
+        # filters, so the new ones are built on a copy and swapped in at once.
+        rf = copy.copy(self)
+
+        rf.computevideofilters()
 
         # This is > 0 because decode_analog_audio is in khz.
-        if self.decode_analog_audio != 0:
-            self.computeaudiofilters()
+        if rf.decode_analog_audio != 0:
+            rf.computeaudiofilters()
 
-        if self.decode_digital_audio:
-            self.computeefmfilter()
+        if rf.decode_digital_audio:
+            rf.computeefmfilter()
 
-        self.computedelays()
+        rf.computedelays()
+
+        self.__dict__.update(rf.__dict__)
 
     def computeefmfilter(self):
         """Frequency-domain equalisation filter for the LaserDisc EFM signal.
@@ -384,7 +412,7 @@ class RFDecode:
 
         """Compute filter coefficients for the given FFTFilter."""
         # Anything above the highest frequency is left as zero.
-        coeffs = np.zeros(self.blocklen, dtype=np.complex)
+        coeffs = np.zeros((self.blocklen // 2) + 1, dtype=np.complex)
 
         # Generate the frequency-domain coefficients by cubic interpolation between the equaliser values.
         a_interp = spi.interp1d(freqs, amp, kind="cubic")
@@ -401,7 +429,9 @@ class RFDecode:
             np.cos(bin_phase) + (complex(0, -1) * np.sin(bin_phase))
         )
 
-        self.Filters["Fefm"] = coeffs * 8
+        # The filter is one-sided, so taking the real part of its output halves
+        # the gain.  demodblock uses irfft, which gives that real part directly.
+        self.Filters["Fefm"] = coeffs * 4
 
     def computevideofilters(self):
         self.Filters = {}
@@ -541,13 +571,40 @@ class RFDecode:
             )
             SF["FVideoPilot"] = SF["Fvideo_lpf"] * SF["Fdeemp"] * SF["Fpilot"]
 
+        # demodblock works on half spectra from rfft, so only the non-negative
+        # frequencies of the filters it applies are kept.  (RFVideo includes
+        # the Hilbert filter, which zeroes the rest anyway.)
+        half = (self.blocklen // 2) + 1
+        for k in [
+            "Frfhpf",
+            "MTF",
+            "RFVideo",
+            "Fvideo_hpf",
+            "FVideo",
+            "FVideo05",
+            "FVideoBurst",
+            "FVideoPilot",
+        ]:
+            if k in SF:
+                SF[k] = SF[k][:half].copy()
+
+        # RFVideo * MTF ** level for each MTF level in use, filled in by
+        # rfvideo_filter()
+        SF["RFVideo_MTF"] = {0: SF["RFVideo"]}
+
     # frequency domain slicers.  first and second stages use different ones...
     def audio_fdslice(self, freqdomain):
+        hi = self.Filters["audio_fdslice_hi"]
+        if freqdomain.shape[-1] < self.blocklen:
+            # A half spectrum from rfft, where the negative frequencies are
+            # the conjugates of the positive ones
+            mirror = slice(self.blocklen - hi.stop + 1, self.blocklen - hi.start + 1)
+            hi_data = np.conj(freqdomain[..., mirror][..., ::-1])
+        else:
+            hi_data = freqdomain[..., hi]
+
         return np.concatenate(
-            [
-                freqdomain[self.Filters["audio_fdslice_lo"]],
-                freqdomain[self.Filters["audio_fdslice_hi"]],
-            ]
+            [freqdomain[..., self.Filters["audio_fdslice_lo"]], hi_data], axis=-1
         )
 
     def audio_fdslice2(self, freqdomain):
@@ -671,28 +728,68 @@ class RFDecode:
     def hztoire(self, hz):
         return (hz - self.SysParams["ire0"]) / self.SysParams["hz_ire"]
 
-    def demodblock(self, data=None, mtf_level=0, fftdata=None, cut=False):
-        rv = {}
-
-        mtf_level *= self.mtf_mult
-        mtf_level *= self.DecoderParams["MTF_basemult"]
-        mtf_level += self.mtf_offset
+    def blockfft(self, data):
+        """ FFT of a raw block (or the rows of a 2-D array of blocks), in the
+            form demodblock takes as fftdata """
+        return npfft.rfft(data[..., : self.blocklen])
 
+    def demodblock(
+        self, data=None, mtf_level=0, fftdata=None, cut=False, products=None
+    ):
+        """ Demodulate a block.  products is the set of outputs (from
+            DEMOD_PRODUCTS) to compute, defaulting to self.demod_products.
+            "demod" is always included. """
+        # The input is real, so only the half spectrum from rfft is used
         if fftdata is not None:
             indata_fft = fftdata
         elif data is not None:
-            indata_fft = npfft.fft(data[: self.blocklen])
+            indata_fft = self.blockfft(data)
         else:
             raise Exception("demodblock called without raw or FFT data")
 
+        return self.demodblocks(indata_fft[np.newaxis], mtf_level, cut, products)[0]
+
+    def rfvideo_filter(self, mtf_level):
+        """ The RF video filter with MTF compensation for mtf_level applied.
+            DemodCache only asks for levels in steps of its MTF_tolerance, so
+            each is built once and kept in a table. """
+        table = self.Filters["RFVideo_MTF"]
+
+        filt = table.get(mtf_level)
+        if filt is None:
+            filt = self.Filters["RFVideo"] * (self.Filters["MTF"] ** mtf_level)
+
+            # Don't let levels from elsewhere build up without limit
+            if len(table) >= 64:
+                table.clear()
+            table[mtf_level] = filt
+
+        return filt
+
+    def demodblocks(self, fftdata, mtf_level=0, cut=False, products=None):
+        """ Demodulate a batch of blocks, given as a 2-D array of their FFTs
+            (one per row).  Each stage runs once over the whole batch.  Returns
+            a list of each block's output, as from demodblock. """
+        if products is None:
+            products = self.demod_products
+
+        mtf_level *= self.mtf_mult
+        mtf_level *= self.DecoderParams["MTF_basemult"]
+        mtf_level += self.mtf_offset
+
+        indata_fft = fftdata
+        numblocks = len(indata_fft)
+        rv = [{} for i in range(numblocks)]
+
         rotdelay = 0
         if getattr(self, "delays", None) is not None and "video_rot" in self.delays:
             rotdelay = self.delays["video_rot"]
 
-        rv["rfhpf"] = npfft.ifft(indata_fft * self.Filters["Frfhpf"]).real
-        rv["rfhpf"] = rv["rfhpf"][
-            self.blockcut - rotdelay : -self.blockcut_end - rotdelay
-        ]
+        if "rfhpf" in products:
+            rfhpf = npfft.irfft(indata_fft * self.Filters["Frfhpf"], self.blocklen)
+            rfhpf = rfhpf[:, self.blockcut - rotdelay : -self.blockcut_end - rotdelay]
+            for i in range(numblocks):
+                rv[i]["rfhpf"] = rfhpf[i]
 
         if self.system == "PAL" and self.PAL_V4300D_NotchFilter:
             """ This routine works around an 'interesting' issue seen with LD-V4300D players and 
@@ -706,102 +803,94 @@ class RFDecode:
                 int(self.blocklen * (8.42 / self.freq)),
                 int(1 + (self.blocklen * (8.6 / self.freq))),
             )
-            sq_sl = sqsum(indata_fft[sl])
-            m = np.mean(sq_sl) + (np.std(sq_sl) * 3)
+            for block_fft in indata_fft:
+                sq_sl = sqsum(block_fft[sl])
+                m = np.mean(sq_sl) + (np.std(sq_sl) * 3)
 
-            for i in np.where(sq_sl > m)[0]:
-                indata_fft[(i - 1 + sl.start)] = 0
-                indata_fft[(i + sl.start)] = 0
-                indata_fft[(i + 1 + sl.start)] = 0
-                indata_fft[self.blocklen - (i + sl.start)] = 0
-                indata_fft[self.blocklen - (i - 1 + sl.start)] = 0
-                indata_fft[self.blocklen - (i + 1 + sl.start)] = 0
+                for i in np.where(sq_sl > m)[0]:
+                    block_fft[(i - 1 + sl.start)] = 0
+                    block_fft[(i + sl.start)] = 0
+                    block_fft[(i + 1 + sl.start)] = 0
 
-        indata_fft_filt = indata_fft * self.Filters["RFVideo"]
+        indata_fft_filt = indata_fft * self.rfvideo_filter(mtf_level)
 
-        if mtf_level != 0:
-            indata_fft_filt *= self.Filters["MTF"] ** mtf_level
-
-        hilbert = npfft.ifft(indata_fft_filt)
-        demod = unwrap_hilbert(hilbert, self.freq_hz)
-
-        demod_fft_full = npfft.fft(demod)
-        demod_hpf = npfft.ifft(demod_fft_full * self.Filters["Fvideo_hpf"]).real
+        # The negative frequencies of the analytic signal are zero, so the half
+        # spectrum is zero-padded back out to the full block length.
+        hilbert = npfft.ifft(indata_fft_filt, self.blocklen)
+        demod = fm_discriminate(hilbert, self.freq_hz)
 
         # use a clipped demod for video output processing to reduce speckling impact
-        demod_fft = npfft.fft(np.clip(demod, 1500000, self.freq_hz * 0.75))
+        demod_fft = npfft.rfft(np.clip(demod, 1500000, self.freq_hz * 0.75))
 
-        out_video = npfft.ifft(demod_fft * self.Filters["FVideo"]).real
+        video = {}
+        video["demod"] = npfft.irfft(demod_fft * self.Filters["FVideo"], self.blocklen)
 
-        out_video05 = npfft.ifft(demod_fft * self.Filters["FVideo05"]).real
-        out_video05 = np.roll(out_video05, -self.Filters["F05_offset"])
+        if "demod_raw" in products:
+            video["demod_raw"] = demod
 
-        out_videoburst = npfft.ifft(demod_fft * self.Filters["FVideoBurst"]).real
+        if "demod_hpf" in products:
+            video["demod_hpf"] = npfft.irfft(
+                npfft.rfft(demod) * self.Filters["Fvideo_hpf"], self.blocklen
+            )
 
-        if self.system == "PAL":
-            out_videopilot = npfft.ifft(demod_fft * self.Filters["FVideoPilot"]).real
-            video_out = np.rec.array(
-                [
-                    out_video,
-                    demod,
-                    demod_hpf,
-                    out_video05,
-                    out_videoburst,
-                    out_videopilot,
-                ],
-                names=[
-                    "demod",
-                    "demod_raw",
-                    "demod_hpf",
-                    "demod_05",
-                    "demod_burst",
-                    "demod_pilot",
-                ],
+        if "demod_05" in products:
+            out_video05 = npfft.irfft(
+                demod_fft * self.Filters["FVideo05"], self.blocklen
             )
-        else:
-            video_out = np.rec.array(
-                [out_video, demod, demod_hpf, out_video05, out_videoburst],
-                names=["demod", "demod_raw", "demod_hpf", "demod_05", "demod_burst"],
+            video["demod_05"] = np.roll(out_video05, -self.Filters["F05_offset"], -1)
+
+        if "demod_burst" in products:
+            video["demod_burst"] = npfft.irfft(
+                demod_fft * self.Filters["FVideoBurst"], self.blocklen
             )
 
-        rv["video"] = (
-            video_out[self.blockcut : -self.blockcut_end] if cut else video_out
-        )
+        if "demod_pilot" in products and self.system == "PAL":
+            video["demod_pilot"] = npfft.irfft(
+                demod_fft * self.Filters["FVideoPilot"], self.blocklen
+            )
+
+        names = [k for k in self.DEMOD_PRODUCTS if k in video]
+        video_out = np.rec.array([video[k] for k in names], names=names)
+        if cut:
+            video_out = video_out[:, self.blockcut : -self.blockcut_end]
+
+        for i in range(numblocks):
+            rv[i]["video"] = video_out[i]
 
         if self.decode_digital_audio:
-            efm_out = npfft.ifft(indata_fft * self.Filters["Fefm"])
+            efm_out = npfft.irfft(indata_fft * self.Filters["Fefm"], self.blocklen)
             if cut:
-                efm_out = efm_out[self.blockcut : -self.blockcut_end]
-            rv["efm"] = np.int16(np.clip(efm_out.real, -32768, 32767))
+                efm_out = efm_out[:, self.blockcut : -self.blockcut_end]
+            efm_out = np.int16(np.clip(efm_out, -32768, 32767))
+            for i in range(numblocks):
+                rv[i]["efm"] = efm_out[i]
 
         if self.decode_analog_audio:
             # Audio phase 1
             hilbert = npfft.ifft(
                 self.audio_fdslice(indata_fft) * self.Filters["audio_lfilt"]
             )
-            audio_left = (
-                unwrap_hilbert(hilbert, self.Filters["freq_arf"])
-                + self.Filters["audio_lowfreq"]
-            )
+            audio_left = fm_discriminate(hilbert, self.Filters["freq_arf"])
+            audio_left += self.Filters["audio_lowfreq"]
 
             hilbert = npfft.ifft(
                 self.audio_fdslice(indata_fft) * self.Filters["audio_rfilt"]
             )
-            audio_right = (
-                unwrap_hilbert(hilbert, self.Filters["freq_arf"])
-                + self.Filters["audio_lowfreq"]
-            )
+            audio_right = fm_discriminate(hilbert, self.Filters["freq_arf"])
+            audio_right += self.Filters["audio_lowfreq"]
 
             audio_out = np.rec.array(
                 [audio_left, audio_right], names=["audio_left", "audio_right"]
             )
 
-            fdiv = video_out.shape[0] // audio_out.shape[0]
-            rv["audio"] = (
-                audio_out[self.blockcut // fdiv : -self.blockcut_end // fdiv]
-                if cut
-                else audio_out
-            )
+            if cut:
+                fdiv = self.blocklen // audio_out.shape[-1]
+                audio_out = audio_out[
+                    :, self.blockcut // fdiv : -self.blockcut_end // fdiv
+                ]
+
+            for i in range(numblocks):
+                rv[i]["audio"] = audio_out[i]
 
         return rv
 
@@ -827,18 +916,15 @@ class RFDecode:
 
         # Locate areas with impossible signals and perform interpolation
 
-        reject_locs = np.where(rejects)[0]
-        reject_areas = []
-        cur_area = [reject_locs[0] - padding, reject_locs[0] + padding]
-
-        for r in np.where(rejects)[0][1:]:
-            if (r - padding) > cur_area[1]:
-                reject_areas.append(tuple(cur_area))
-                cur_area = [r - padding, r + padding]
-            else:
-                cur_area[1] = r + padding
-
-        reject_areas.append(cur_area)
+        # A reject more than 2 * padding past the previous one starts a new area
+        reject_locs = np.flatnonzero(rejects)
+        breaks = np.flatnonzero(np.diff(reject_locs) > (2 * padding)) + 1
+        reject_areas = list(
+            zip(
+                reject_locs[np.concatenate(([0], breaks))] - padding,
+                reject_locs[np.concatenate((breaks - 1, [-1]))] + padding,
+            )
+        )
 
         field_audio_dod = field_audio.copy()
 
@@ -866,81 +952,10 @@ class RFDecode:
 
         return field_audio_dod
 
-    # Second phase audio filtering.  This works on a whole field's samples, since
-    # the frequency has already been reduced by 16 or 32x.
-
-    def runfilter_audio_phase2(self, frame_audio, start):
-        outputs = []
-
-        clips = None
-
-        for c in [["audio_left", "audio_lfreq"], ["audio_right", "audio_rfreq"]]:
-            raw = (
-                frame_audio[c[0]][start : start + self.blocklen].copy()
-                - self.SysParams[c[1]]
-            )
-
-            if c[0] == "audio_left":
-                clips = findpeaks(raw, 300000)
-
-            for l in clips:
-                replacelen = 16 * self.Filters["audio_fdiv2"]
-                raw[
-                    max(0, l - replacelen) : min(l + replacelen, len(raw))
-                ] = 0  # raw[replacement_idx]
-
-            fft_in_real = self.audio_fdslice2(npfft.fft(raw))
-            if len(fft_in_real) < len(self.Filters["audio_lpf2"]):
-                fft_in = np.zeros_like(self.Filters["audio_lpf2"])
-                fft_in[: len(fft_in_real)] = fft_in_real
-            else:
-                fft_in = fft_in_real
-            fft_out = fft_in * self.Filters["audio_lpf2"] * self.Filters["audio_deemp2"]
-
-            outputs.append(
-                (
-                    npfft.ifft(fft_out).real[: len(fft_in_real)]
-                    / self.Filters["audio_fdiv2"]
-                )
-                + self.SysParams[c[1]]
-            )
-
-        return np.rec.array(outputs, names=["audio_left", "audio_right"])
-
     def audio_phase2(self, field_audio):
-        # this creates an output array with left/right channels.
-        output_audio2 = np.zeros(
-            len(field_audio["audio_left"]) // self.Filters["audio_fdiv2"],
-            dtype=field_audio.dtype,
-        )
-
-        field_audio = self.audio_dropout_detector(field_audio)
-
-        # copy the first block in it's entirety, to keep audio and video samples aligned
-        tmp = self.runfilter_audio_phase2(field_audio, 0)
-
-        if len(tmp) >= len(output_audio2):
-            return tmp[: len(output_audio2)]
-
-        output_audio2[: tmp.shape[0]] = tmp
-
-        end = field_audio.shape[0]
-
-        askip = 512  # length of filters that needs to be chopped out of the ifft
-        sjump = self.blocklen - (askip * self.Filters["audio_fdiv2"])
-
-        ostart = tmp.shape[0]
-        for sample in range(sjump, field_audio.shape[0] - sjump, sjump):
-            tmp = self.runfilter_audio_phase2(field_audio, sample)
-
-            oend = ostart + tmp.shape[0] - askip
-            output_audio2[ostart:oend] = tmp[askip:]
-            ostart += tmp.shape[0] - askip
-
-        tmp = self.runfilter_audio_phase2(field_audio, end - self.blocklen - 1)
-        output_audio2[output_audio2.shape[0] - (tmp.shape[0] - askip) :] = tmp[askip:]
-
-        return output_audio2
+        """ Second phase audio filtering of one stretch of first phase audio.
+            DemodCache filters successive reads as a stream (see AudioPhase2). """
+        return AudioPhase2(self).process(field_audio, 0)
 
     def computedelays(self, mtf_level=0):
         """Generate a fake signal and compute filter delays.
@@ -1009,7 +1024,9 @@ class RFDecode:
         fakesignal += 8192
         fakesignal[6000:6005] = 0
 
-        fakedecode = rf.demodblock(fakesignal, mtf_level=mtf_level)
+        fakedecode = rf.demodblock(
+            fakesignal, mtf_level=mtf_level, products={"demod", "demod_raw"}
+        )
         vdemod = fakedecode["video"]["demod"]
 
         # XXX: sync detector does NOT reflect actual sync detection, just regular filtering @ sync level
@@ -1046,6 +1063,333 @@ class RFDecode:
         return fakedecode, fakeoutput_emp
 
 
+class AudioPhase2:
+    """ Second phase audio filtering, run as a stream over the first phase
+        audio of successive DemodCache reads, so that each sample is only
+        filtered once.
+
+        The filters are applied (overlap-save) to blocklen first phase samples
+        at a time, starting askip output samples before the first one needed so
+        that they have settled.  A read that starts before the output that's
+        kept, or after a gap, restarts the stream.
+
+        align -- Reads start at a multiple of this many first phase samples
+        rate  -- Sample rate the stream is filtered at.  Reads are returned at
+                 rf.Filters["freq_aud2"], so this has to be a multiple of that.
+                 The default is the lowest rate with a sample at every place a
+                 read can start.
+    """
+
+    # length of filters that needs to be chopped out of the ifft
+    askip = 512
+
+    channels = [("audio_left", "audio_lfreq"), ("audio_right", "audio_rfreq")]
+
+    # Rising left channel samples this far off the carrier are clicks
+    click_level = 300000
+
+    def __init__(self, rf, align=1, rate=None):
+        self.rf = rf
+
+        fdiv2 = rf.Filters["audio_fdiv2"]
+        if rate is None:
+            rate = rf.Filters["freq_arf"] / math.gcd(fdiv2, align)
+
+        # First phase samples per stream sample
+        self.sdiv = int(round(rf.Filters["freq_arf"] / rate))
+        if self.sdiv < 1 or fdiv2 % self.sdiv:
+            raise ValueError(
+                "AudioPhase2: rate must be a multiple of %d" % rf.Filters["freq_aud2"]
+            )
+        self.rate = rf.Filters["freq_arf"] / self.sdiv
+
+        self.reset(0)
+
+    def reset(self, start):
+        """ Restart the stream at first phase sample start """
+        # Filter input (carrier removed, with clicks blanked) from first phase
+        # sample instart, and output from stream sample outstart.
+        self.instart = start - (start % self.sdiv)
+        self.inbuf = np.zeros((2, start - self.instart))
+        self.outstart = self.instart // self.sdiv
+        self.outbuf = np.zeros((2, 0))
+
+        # The first output isn't preceded by anything to settle the filters with
+        self.fresh = True
+
+    def addinput(self, field_audio):
+        """ Add first phase audio to the end of the filter input """
+        field_audio = self.rf.audio_dropout_detector(field_audio)
+
+        raw = np.stack(
+            [
+                field_audio[name] - self.rf.SysParams[freq]
+                for name, freq in self.channels
+            ]
+        )
+
+        # detect clicks in the left channel, and blank both channels around them.
+        # The last sample added before is checked again, now the next is known.
+        checkfrom = max(self.inbuf.shape[1] - 1, 0)
+        self.inbuf = np.concatenate([self.inbuf, raw], axis=1)
+
+        left = self.inbuf[0, checkfrom:]
+        clips = np.flatnonzero(
+            (left[:-1] >= self.click_level) & (left[1:] > left[:-1])
+        )
+        if len(clips):
+            replacelen = 16 * self.rf.Filters["audio_fdiv2"]
+            locs = clips + checkfrom - 1
+
+            blank = np.zeros(self.inbuf.shape[1] + 1, dtype=np.int32)
+            np.add.at(blank, np.maximum(locs - replacelen, 0), 1)
+            np.add.at(blank, np.minimum(locs + replacelen, self.inbuf.shape[1]), -1)
+            self.inbuf[:, np.cumsum(blank[:-1]) > 0] = 0
+
+    def filter(self, end):
+        """ Run the filters up to first phase sample end """
+        SF = self.rf.Filters
+        blocklen = self.rf.blocklen
+        warmup = self.askip * SF["audio_fdiv2"]
+
+        filt = SF["audio_lpf2"] * SF["audio_deemp2"]
+        halflen = len(filt) // 2
+        outlen = blocklen // self.sdiv
+
+        outputs = [self.outbuf]
+        outend = self.outstart + self.outbuf.shape[1]
+
+        while outend * self.sdiv < end:
+            chunkstart = outend * self.sdiv
+            if not self.fresh:
+                chunkstart = max(chunkstart - warmup, self.instart)
+
+            # Input past end isn't known yet.  Leaving it as zeroes only upsets
+            # the first outputs (skipped as the filters settle), and the ones
+            # past end (not used until the next call).
+            chunk = np.zeros((2, blocklen))
+            data = self.inbuf[:, chunkstart - self.instart : end - self.instart]
+            chunk[:, : min(blocklen, data.shape[1])] = data[:, :blocklen]
+
+            # This is audio_fdslice2 of the full FFT, with the filters applied,
+            # and zero-padded out to outlen when filtering at a higher rate than
+            # freq_aud2.  The input is real, so the negative frequencies just
+            # mirror the positive ones, except for the lowest (at -halflen).
+            fft_in = npfft.rfft(chunk)
+            fft_out = np.zeros((2, (outlen // 2) + 1), dtype=np.complex128)
+            fft_out[:, :halflen] = fft_in[:, :halflen] * filt[:halflen]
+
+            edge = fft_in[:, halflen] * np.conj(filt[halflen])
+            fft_out[:, halflen] = edge if outlen == len(filt) else edge / 2
+
+            first = outend - (chunkstart // self.sdiv)
+            last = min(outlen, -(-(end - chunkstart) // self.sdiv))
+            outputs.append(npfft.irfft(fft_out, outlen)[:, first:last] / self.sdiv)
+
+            outend = (chunkstart // self.sdiv) + last
+            self.fresh = False
+
+        self.outbuf = np.concatenate(outputs, axis=1)
+
+    def process(self, field_audio, start):
+        """ Filter a read's first phase audio, which starts at first phase
+            sample start.  Returns the read's audio at the freq_aud2 rate. """
+        end = start + len(field_audio)
+
+        inend = self.instart + self.inbuf.shape[1]
+        if start < (self.outstart * self.sdiv) or start > inend:
+            self.reset(start)
+            inend = start
+
+        if end > inend:
+            self.addinput(field_audio[inend - start :])
+
+        self.filter(end)
+
+        # Output from before this read's start isn't needed again, and the
+        # filters only need warmup input from before the end of the output.
+        first = (start // self.sdiv) - self.outstart
+        self.outbuf = self.outbuf[:, first:]
+        self.outstart += first
+
+        outend = self.outstart + self.outbuf.shape[1]
+        keep = (outend * self.sdiv) - (self.askip * self.rf.Filters["audio_fdiv2"])
+        if keep > self.instart:
+            self.inbuf = self.inbuf[:, keep - self.instart :]
+            self.instart = keep
+
+        step = self.rf.Filters["audio_fdiv2"] // self.sdiv
+        length = len(field_audio) // self.rf.Filters["audio_fdiv2"]
+
+        outputs = []
+        for i, (name, freq) in enumerate(self.channels):
+            outputs.append(
+                self.outbuf[i, : length * step : step] + self.rf.SysParams[freq]
+            )
+
+        return np.rec.array(outputs, names=[name for name, freq in self.channels])
+
+
+class DemodDiskCache:
+    """ Demodulated blocks saved to disk, so decoding the same input again (i.e.
+        with different field processing options) runs at I/O speed.
+
+        Each MTF level has a file of float32 records, one per block, and an index
+        file with a byte per block that is set once its record is written.  The
+        files are named from a hash of the input file's identity and everything
+        else that changes the demodulated output, so changing any of it starts
+        a new cache.
+    """
+
+    def __init__(self, path, rf, infile, loader):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+        st = os.fstat(infile.fileno())
+        self.identity = (os.path.realpath(infile.name), st.st_size, st.st_mtime_ns)
+
+        self.loader = loader
+        self.files = {}
+        self.sethash(rf)
+
+    def sethash(self, rf):
+        """ Compute the cache file names from rf's current parameters """
+        self.close()
+
+        loader = self.loader
+        loaderdesc = [getattr(loader, "__name__", type(loader).__name__)]
+        if isinstance(loader, LoadResampled):
+            loaderdesc += [loader.up, loader.down, getattr(loader.loader, "__name__", "")]
+
+        desc = {
+            "input": self.identity,
+            "loader": loaderdesc,
+            "decoder": type(rf).__name__,
+            "blocklen": (rf.blocklen, rf.blockcut, rf.blockcut_end),
+            "audio": (
+                getattr(rf, "decode_analog_audio", None),
+                getattr(rf, "decode_digital_audio", None),
+            ),
+            "DecoderParams": rf.DecoderParams,
+            "SysParams": rf.SysParams,
+            "products": sorted(getattr(rf, "demod_products", [])),
+            "mtf": (rf.mtf_mult, rf.mtf_offset),
+            "deemp_mult": rf.deemp_mult,
+            "notch": (rf.NTSC_ColorNotchFilter, rf.PAL_V4300D_NotchFilter),
+        }
+
+        def tojson(v):
+            return v.tolist() if isinstance(v, np.ndarray) else repr(v)
+
+        desc = json.dumps(desc, sort_keys=True, default=tojson)
+        self.hash = hashlib.sha1(desc.encode()).hexdigest()[:16]
+        self.layout = None
+
+        layoutfile = os.path.join(self.path, self.hash + ".json")
+        if os.path.exists(layoutfile):
+            with open(layoutfile, "r") as fp:
+                self.layout = [tuple(l) for l in json.load(fp)]
+
+    def setlayout(self, demod):
+        """ Set the record layout from a block's demodulated output.  Returns
+            False if it doesn't match the layout already in use. """
+        layout = []
+        for k in sorted(demod.keys()):
+            v = demod[k]
+            if v.dtype.names:
+                for name in v.dtype.names:
+                    layout.append((k, name, len(v), v.dtype[name].str))
+            else:
+                layout.append((k, None, len(v), v.dtype.str))
+
+        if self.layout is None:
+            self.layout = layout
+            with open(os.path.join(self.path, self.hash + ".json"), "w") as fp:
+                json.dump(layout, fp)
+
+        return layout == self.layout
+
+    def open(self, mtfstep):
+        if mtfstep not in self.files:
+            name = os.path.join(self.path, "%s_%d" % (self.hash, mtfstep))
+            for ext in (".f32", ".idx"):
+                if not os.path.exists(name + ext):
+                    open(name + ext, "wb").close()
+
+            index = open(name + ".idx", "r+b")
+            self.files[mtfstep] = {
+                "name": name + ".f32",
+                "data": open(name + ".f32", "r+b"),
+                "index": index,
+                "present": bytearray(index.read()),
+                "map": None,
+            }
+
+        return self.files[mtfstep]
+
+    def recordlen(self):
+        return sum(l[2] for l in self.layout)
+
+    def store(self, mtfstep, blocknum, demod):
+        if not self.setlayout(demod):
+            return
+
+        record = []
+        for k, name, length, dtype in self.layout:
+            record.append((demod[k][name] if name else demod[k]).astype(np.float32))
+
+        f = self.open(mtfstep)
+        f["data"].seek(blocknum * self.recordlen() * 4)
+        f["data"].write(np.concatenate(record).tobytes())
+        f["data"].flush()
+
+        f["index"].seek(blocknum)
+        f["index"].write(b"\x01")
+        f["index"].flush()
+
+        if len(f["present"]) <= blocknum:
+            f["present"].extend(bytes(blocknum + 1 - len(f["present"])))
+        f["present"][blocknum] = 1
+
+    def load(self, mtfstep, blocknum):
+        """ Return a block's demodulated output, or None if it isn't cached """
+        if self.layout is None:
+            return None
+
+        f = self.open(mtfstep)
+        if blocknum >= len(f["present"]) or not f["present"][blocknum]:
+            return None
+
+        recordlen = self.recordlen()
+        end = (blocknum + 1) * recordlen
+        if f["map"] is None or len(f["map"]) < end:
+            f["map"] = np.memmap(f["name"], np.float32, "r")
+        record = f["map"][end - recordlen : end]
+
+        fields = {}
+        offset = 0
+        for k, name, length, dtype in self.layout:
+            fields.setdefault(k, []).append(
+                (name, record[offset : offset + length].astype(dtype))
+            )
+            offset += length
+
+        demod = {}
+        for k, v in fields.items():
+            if v[0][0] is None:
+                demod[k] = v[0][1]
+            else:
+                demod[k] = np.rec.fromarrays([a for n, a in v], names=[n for n, a in v])
+
+        return demod
+
+    def close(self):
+        for f in getattr(self, "files", {}).values():
+            f["data"].close()
+            f["index"].close()
+        self.files = {}
+
+
 class DemodCache:
     def __init__(
         self,
@@ -1055,46 +1399,148 @@ class DemodCache:
         cachesize=256,
         num_worker_threads=6,
         MTF_tolerance=0.05,
+        readahead=64,
+        cache_mb=None,
+        demod_cache=None,
+        backend="process",
+        max_batch=4,
     ):
         self.infile = infile
         self.loader = loader
         self.rf = rf
 
-        self.currentMTF = 1
+        # Optional on-disk cache of demodulated blocks, which needs a real file
+        self.diskcache = None
+        if demod_cache is not None:
+            if infile.seekable():
+                self.diskcache = DemodDiskCache(demod_cache, rf, infile, loader)
+            else:
+                logger.warning("Not using the demod cache, as the input isn't a file")
+
+        # Demodulated output is cached per block under a key of the MTF level
+        # (in steps of MTF_tolerance) and the decoder parameters' version, so
+        # going back to an earlier MTF doesn't demodulate again, and output
+        # from before setparams() is never used.
         self.MTF_tolerance = MTF_tolerance
+        self.paramsversion = 0
+        self.currentkey = self.demodkey(1)
 
         self.blocksize = self.rf.blocklen - (self.rf.blockcut + self.rf.blockcut_end)
 
-        # Cache dictionary - key is block #, which holds data for that block
-        self.lrusize = cachesize
-        self.prefetch = 32  # TODO: set this to proper amount for format
-        self.lru = []
+        # Size of a demodulated block's output, from a test block
+        self.demodbytes = self.measureblock()
+
+        # The cache's memory budget (in bytes) and prefetch depth are adjusted
+        # in adapt() as decoding goes on.  If cache_mb is given the budget is
+        # kept to that.
+        self.cache_budget = cachesize * self.blockbytes()
+        self.prefetch = 32
+
+        self.cache_mb = cache_mb
+        if cache_mb is not None:
+            self.cache_budget = cache_mb * 1024 * 1024
 
+        # Smoothed blocks advanced per read(), and main thread time between reads
+        self.read_advance = None
+        self.main_time = None
+        self.last_read = None
+        self.adapt_logged = None
+
+        # Second phase audio filter, carried from one read to the next
+        self.audio_phase2 = None
+
+        # Cache dictionary - key is block #, which holds data for that block.
+        # It's kept in LRU order (oldest first), and heldbytes has the memory
+        # used by each block, which adds up to cachebytes.
         self.lock = threading.Lock()
-        self.blocks = {}
+        self.blocks = OrderedDict()
+        self.heldbytes = {}
+        self.cachebytes = 0
+
+        # Raw blocks are loaded by the reader thread, up to readahead blocks past
+        # the last one read() asked for.  rawblocks holds them until they are
+        # moved into the cache, and read_eof is the first block past EOF.
+        # read_error has an exception raised by the loader at read_next, which
+        # stops the reader until fetchblocks moves it.
+        self.readahead = readahead
+        self.rawblocks = {}
+        self.read_next = 0
+        self.read_until = 0
+        self.read_eof = None
+        self.read_error = None
+        self.read_cond = threading.Condition()
+        # Held around loader calls, which seek and read infile
+        self.loader_lock = threading.Lock()
+        self.ending = False
+
+        # Seconds spent reading input and demodulating, and how much of that
+        # the main thread spent waiting for
+        self.stats = {
+            "read": 0.0,
+            "read_wait": 0.0,
+            "demod": 0.0,
+            "demod_wait": 0.0,
+            "blocks": 0,
+            "diskblocks": 0,
+        }
+
+        # Queued demodulation requests: block # -> list of (key, threading.Event),
+        # and the event is set once the result is in the cache
+        self.pending = {}
+
+        # Blocks are demodulated by worker processes, by worker threads which
+        # share the cache's arrays, or by the serial backend in read() itself.
+        self.backend = backend
+        if backend not in ("process", "thread", "serial"):
+            raise ValueError("Unknown DemodCache backend %s" % backend)
+
+        if backend == "process":
+            self.q_in = JoinableQueue()
+            self.q_out = Queue()
+        else:
+            self.q_in = queue.Queue()
+            self.q_out = queue.Queue()
 
-        self.q_in = JoinableQueue()
-        self.q_in_metadata = []
+        # Most blocks a worker demodulates together
+        self.max_batch = max_batch
 
-        self.q_out = Queue()
+        # Shared memory for passing blocks to and from the workers, which has to
+        # exist before they are started
+        self.slots = self.makeslots() if backend == "process" else None
 
         self.threadpipes = []
         self.threads = []
 
         num_worker_threads = max(num_worker_threads - 1, 1)
+        if backend == "serial":
+            num_worker_threads = 0
 
         for i in range(num_worker_threads):
-            self.threadpipes.append(Pipe())
-            t = Process(
-                target=self.worker, daemon=True, args=(self.threadpipes[-1][1],)
-            )
+            if backend == "process":
+                # Parameter changes are sent to each process through its pipe
+                self.threadpipes.append(Pipe())
+                t = Process(
+                    target=self.worker, daemon=True, args=(self.threadpipes[-1][1],)
+                )
+            else:
+                t = threading.Thread(target=self.worker, daemon=True, args=(None,))
             t.start()
             self.threads.append(t)
 
-        self.deqeue_thread = threading.Thread(target=self.dequeue, daemon=True)
-        self.deqeue_thread.start()
+        self.deqeue_thread = None
+        if backend != "serial":
+            self.deqeue_thread = threading.Thread(target=self.dequeue, daemon=True)
+            self.deqeue_thread.start()
+
+        self.reader_thread = threading.Thread(target=self.reader, daemon=True)
+        self.reader_thread.start()
 
     def end(self):
+        # stop the reader thread
+        with self.read_cond:
+            self.ending = True
+            self.read_cond.notify_all()
+
         # stop workers
         for i in self.threads:
             self.q_in.put(None)
@@ -1102,33 +1548,255 @@ class DemodCache:
         for t in self.threads:
             t.join()
 
-        self.q_out.put(None)
+        if self.deqeue_thread is not None:
+            self.q_out.put(None)
+            self.deqeue_thread.join()
+            self.deqeue_thread = None
+
+        if self.slots is not None:
+            self.slots.close()
+            self.slots = None
+
+        if self.diskcache is not None:
+            self.diskcache.close()
+
+    def measureblock(self):
+        """ Return the size in bytes of a block's demodulated output, found by
+            demodulating a test block, or None if that fails. """
+        try:
+            testblock = np.random.default_rng(0).normal(0, 8192, self.rf.blocklen)
+            demod = self.rf.demodblock(
+                fftdata=self.rf.blockfft(testblock), mtf_level=0, cut=True
+            )
+        except Exception:
+            return None
+
+        return sum(v.nbytes for v in demod.values() if isinstance(v, np.ndarray))
+
+    def blockbytes(self):
+        """ Estimated memory used by a cached block """
+        # Raw input (usually 16-bit) and complex FFT, and demod output - assume
+        # six float64 channels if it couldn't be measured
+        demodbytes = self.demodbytes if self.demodbytes else self.rf.blocklen * 48
+        return (self.rf.blocklen * (2 + 16)) + demodbytes
+
+    def makeslots(self):
+        """ Create the shared memory slots used to pass blocks to the workers,
+            each big enough for a block's input, FFT and demodulated output.
+            Returns None (so blocks are pickled instead) if that isn't possible.
+        """
+        blocklen = self.rf.blocklen
+
+        if self.demodbytes is None:
+            return None
+
+        # Demodulated output, complex FFT, then raw input of up to 8 bytes/sample
+        slotsize = self.demodbytes + (blocklen * 16) + (blocklen * 8)
+
+        if isinstance(self.loader, LoadResampled):
+            # The resampler source data in, and the resampled input back
+            sourcelen = (blocklen * self.loader.down) // self.loader.up
+            sourcelen += (self.loader.margin + self.loader.down) * 2
+            slotsize += (sourcelen * 4) + (blocklen * 4)
+
+        # Leave room for alignment padding
+        slotsize += 64 * 32
+
+        # Enough for a field's worth of blocks plus prefetch, but leave most of
+        # /dev/shm free, as it can be small (i.e. in containers)
+        count = self.prefetch + 32
+        try:
+            st = os.statvfs("/dev/shm")
+            count = min(count, (st.f_bavail * st.f_frsize) // (slotsize * 2))
+        except OSError:
+            pass
+
+        if count < 4:
+            return None
+
+        try:
+            return SharedSlots(count, slotsize)
+        except (OSError, ValueError):
+            return None
 
     def __del__(self):
         self.end()
 
+    def adapt(self, firstblock, numblocks, readstart):
+        """ Size the prefetch window and cache from how many blocks each read()
+            moves forward, how long the main thread takes between reads, and
+            how long the workers take per block, so that the workers are kept
+            busy while the main thread processes a field.  Called at the end
+            of read(). """
+        now = time.perf_counter()
+
+        if self.last_read is not None:
+            lastblock, lasttime = self.last_read
+            advance = firstblock - lastblock
+
+            # Ignore seeks and re-reads
+            if 0 < advance <= numblocks * 2:
+                main_time = readstart - lasttime
+
+                if self.read_advance is None:
+                    self.read_advance, self.main_time = advance, main_time
+                else:
+                    self.read_advance = (self.read_advance * 0.8) + (advance * 0.2)
+                    self.main_time = (self.main_time * 0.8) + (main_time * 0.2)
+
+        self.last_read = (firstblock, now)
+
+        # Nothing to tune without workers, or before any blocks have been
+        # demodulated (e.g. when they all come from the disk cache)
+        if self.backend == "serial" or self.stats["blocks"] == 0:
+            return
+
+        if self.read_advance is None or self.stats["blocks"] < len(self.threads) * 4:
+            return
+
+        # Blocks the workers can demodulate while the main thread works on a
+        # field.  If that's more than a field, prefetch further ahead (up to
+        # four fields) so they have something to do.  Either way, keep the next
+        # field queued.
+        blocktime = self.stats["demod"] / self.stats["blocks"]
+        workerblocks = (len(self.threads) * self.main_time) / max(blocktime, 1e-6)
+        workerblocks = np.clip(workerblocks, self.read_advance, self.read_advance * 4)
+
+        prefetch = int(np.ceil(workerblocks + self.read_advance))
+
+        # Keep the current and previous reads in the cache, for field re-reads
+        keep = numblocks * 2
+
+        # Size blocks from what demodulated blocks actually hold, as prefetched
+        # blocks only have their raw data at first
+        self.lock.acquire()
+        demodbytes = [
+            self.heldbytes.get(b, 0)
+            for b, block in self.blocks.items()
+            if block is not None and block.get("demod")
+        ]
+        self.lock.release()
+
+        if len(demodbytes):
+            perblock = np.mean(demodbytes)
+        else:
+            perblock = self.blockbytes()
+
+        if self.cache_mb is None:
+            self.cache_budget = max(self.cache_budget, (prefetch + keep) * perblock)
+        else:
+            self.cache_budget = self.cache_mb * 1024 * 1024
+            if (prefetch + keep) * perblock > self.cache_budget:
+                prefetch = int(self.cache_budget // perblock) - keep
+                prefetch = max(prefetch, int(np.ceil(self.read_advance)))
+                if (prefetch + keep) * perblock > self.cache_budget:
+                    # Too small to work at all, so go over budget
+                    self.cache_budget = (prefetch + keep) * perblock
+
+        self.prefetch = prefetch
+        self.readahead = max(self.readahead, prefetch + numblocks)
+
+        # Log the first choice, and then any big changes
+        if self.adapt_logged is None or not (
+            0.75 <= (self.prefetch / self.adapt_logged) <= 1.33
+        ):
+            log = logger.info if self.adapt_logged is None else logger.debug
+            log(
+                "Prefetching %d blocks, caching up to %d MB (about %d blocks)",
+                self.prefetch,
+                self.cache_budget // (1024 * 1024),
+                self.cache_budget // perblock,
+            )
+            self.adapt_logged = self.prefetch
+
+    def blockmemory(self, block):
+        """ Return the bytes held by a cache entry's arrays """
+        if block is None:
+            return 0
+
+        held = 0
+        for k, v in block.items():
+            if k == "input":
+                # A view of rawinput
+                continue
+            elif k == "demod":
+                for demod in v.values():
+                    held += sum(
+                        a.nbytes for a in demod.values() if isinstance(a, np.ndarray)
+                    )
+            elif k == "rawsource":
+                held += v[0].nbytes
+            elif isinstance(v, np.ndarray):
+                held += v.nbytes
+
+        return held
+
+    def updatebytes(self, b):
+        """ Update the memory accounting for block b.  Call with self.lock held. """
+        self.cachebytes -= self.heldbytes.pop(b, 0)
+
+        if b in self.blocks:
+            self.heldbytes[b] = self.blockmemory(self.blocks[b])
+            self.cachebytes += self.heldbytes[b]
+
     def prune_cache(self):
-        """ Prune the LRU cache.  Typically run when a new field is loaded """
-        if len(self.lru) < self.lrusize:
+        """ Prune the cache down to its memory budget.  Typically run when a new
+            field is loaded.
+
+            Output demodulated at other MTF levels is dropped first, then FFTs,
+            as they're only needed to demodulate a block again.  Each of these
+            goes least recently used first.  Then whole blocks are evicted.
+            Blocks being demodulated are left alone.
+        """
+        if self.cachebytes <= self.cache_budget:
             return
 
         self.lock.acquire()
-        for k in self.lru[self.lrusize :]:
-            if k in self.blocks:
-                del self.blocks[k]
+
+        for b, block in self.blocks.items():
+            if self.cachebytes <= self.cache_budget:
+                break
+
+            if block is not None and len(block.get("demod", {})) > 1:
+                for key in list(block["demod"].keys()):
+                    if key != self.currentkey:
+                        del block["demod"][key]
+                self.updatebytes(b)
+
+        for b, block in self.blocks.items():
+            if self.cachebytes <= self.cache_budget:
+                break
+
+            if block is not None and "fft" in block and block.get("demod"):
+                if b not in self.pending:
+                    del block["fft"]
+                    self.updatebytes(b)
+
+        for b in list(self.blocks.keys()):
+            if self.cachebytes <= self.cache_budget:
+                break
+
+            if b not in self.pending:
+                del self.blocks[b]
+                self.updatebytes(b)
+
         self.lock.release()
 
-        self.lru = self.lru[: self.lrusize]
+    def demodkey(self, MTF):
+        """ Return the cache key for output demodulated at MTF """
+        return (int(np.round(MTF / self.MTF_tolerance)), self.paramsversion)
 
     def flush_demod(self):
-        """ Flush all demodulation data.  This is called by the field class after calibration (i.e. MTF) is determined to be off """
+        """ Flush all demodulation data.  Not needed when the MTF level changes,
+            as output is cached separately for each level. """
+        self.lock.acquire()
         for k in self.blocks.keys():
             if self.blocks[k] is None:
                 pass
             elif "demod" in self.blocks[k]:
-                self.lock.acquire()
                 del self.blocks[k]["demod"]
-                self.lock.release()
+                self.updatebytes(k)
+        self.lock.release()
 
     def apply_newparams(self, newparams):
         for k in newparams.keys():
@@ -1141,10 +1809,45 @@ class DemodCache:
 
         self.rf.computefilters()
 
+    def demodulate(self, blocks, key):
+        """ Demodulate a batch of blocks at key's MTF level together, returning
+            a list of the output to store in the cache for each. """
+        outputs = [{} for block in blocks]
+        begin = time.perf_counter()
+
+        for block, output in zip(blocks, outputs):
+            if "rawinput" not in block:
+                # Resampling is deferred to here so it runs in parallel
+                output["rawinput"] = self.loader.finish(block["rawsource"])
+                block["rawinput"] = output["rawinput"]
+
+        # FFT the blocks that don't have one yet in a single call
+        need_fft = [i for i, block in enumerate(blocks) if "fft" not in block]
+        if len(need_fft):
+            ffts = self.rf.blockfft(np.stack([blocks[i]["rawinput"] for i in need_fft]))
+            for i, fft in zip(need_fft, ffts):
+                outputs[i]["fft"] = fft
+
+        fftdata = np.stack(
+            [block.get("fft", output.get("fft")) for block, output in zip(blocks, outputs)]
+        )
+
+        demods = self.rf.demodblocks(
+            fftdata, mtf_level=key[0] * self.MTF_tolerance, cut=True
+        )
+
+        blocktime = (time.perf_counter() - begin) / len(blocks)
+        for output, demod in zip(outputs, demods):
+            output["demod"] = demod
+            output["key"] = key
+            output["time"] = blocktime
+
+        return outputs
+
     def worker(self, pipein):
         while True:
             ispiped = False
-            if pipein.poll():
+            if pipein is not None and pipein.poll():
                 item = pipein.recv()
                 ispiped = True
             else:
@@ -1154,87 +1857,322 @@ class DemodCache:
                 return
 
             if item[0] == "DEMOD":
-                blocknum, block, target_MTF = item[1:]
+                requests, key = item[1:]
 
-                output = {}
+                # Make sure any parameter changes made before this was queued
+                # have been applied
+                while self.paramsversion < key[1]:
+                    newparams = pipein.recv()
+                    if newparams[0] == "NEWPARAMS":
+                        self.apply_newparams(newparams[1])
+                        self.paramsversion = newparams[2]
 
-                if "fft" not in block:
-                    output["fft"] = npfft.fft(block["rawinput"])
-                    fftdata = output["fft"]
-                else:
-                    fftdata = block["fft"]
+                blocks = []
+                for blocknum, block, slot, offset in requests:
+                    if slot is not None:
+                        block = self.slots.unpack(slot, block, copy=False)
+                    blocks.append(block)
 
-                if (
-                    "demod" not in block
-                    or np.abs(block["MTF"] - target_MTF) > self.MTF_tolerance
-                ):
-                    output["demod"] = self.rf.demodblock(
-                        fftdata=fftdata, mtf_level=target_MTF, cut=True
-                    )
-                    output["MTF"] = target_MTF
+                outputs = self.demodulate(blocks, key)
 
-                self.q_out.put((blocknum, output))
+                for (blocknum, block, slot, offset), output in zip(requests, outputs):
+                    if slot is not None:
+                        output, offset = self.slots.pack(slot, output, offset)
+
+                    self.q_out.put((blocknum, output, slot))
             elif item[0] == "NEWPARAMS":
                 self.apply_newparams(item[1])
+                self.paramsversion = item[2]
 
             if not ispiped:
                 self.q_in.task_done()
 
-    def doread(self, blocknums, MTF, dodemod=True):
+    def loadblocks(self, first, count):
+        """ Load raw data for count blocks starting at first, returning a list of
+            new cache entries.  If EOF is reached the last entry is None.
+
+            Consecutive blocks are read with a single loader call, so the
+            overlapping areas between them are only read and unpacked once.
+        """
+        blocknums = range(first, first + count)
+
+        if isinstance(self.loader, LoadResampled):
+            # Only read the source data here, the workers do the resampling
+            rv = []
+            for b in blocknums:
+                rawsource = self.loader.prepare(
+                    self.infile, b * self.blocksize, self.rf.blocklen
+                )
+                if rawsource is None:
+                    return rv + [None]
+
+                rv.append({"rawsource": rawsource})
+
+            return rv
+
+        rawblocks = load_blocks(
+            self.loader,
+            self.infile,
+            first * self.blocksize,
+            self.rf.blocklen,
+            self.blocksize,
+            count,
+        )
+
+        if rawblocks is None:
+            # Probably EOF within the run - fall back to reading each block
+            rawblocks = []
+            for b in blocknums:
+                rawblock = load_blocks(
+                    self.loader,
+                    self.infile,
+                    b * self.blocksize,
+                    self.rf.blocklen,
+                    self.blocksize,
+                    1,
+                )
+                if rawblock is None:
+                    return [{"rawinput": r} for r in rawblocks] + [None]
+
+                rawblocks.append(rawblock[0])
+
+        return [{"rawinput": r} for r in rawblocks]
+
+    def reader(self):
+        """ Thread main loop: load raw blocks from read_next up to read_until,
+            a few at a time, so that I/O doesn't hold up decoding. """
+        while True:
+            with self.read_cond:
+                while not self.ending and (
+                    self.read_next >= self.read_until or self.read_error is not None
+                ):
+                    self.read_cond.wait()
+
+                if self.ending:
+                    return
+
+                first = self.read_next
+                count = min(self.read_until - first, 8)
+
+            begin = time.perf_counter()
+            newblocks, error = None, None
+            with self.loader_lock:
+                # If the loader fails, try the first block on its own, so the
+                # blocks before a bad one can still be read
+                for n in sorted({count, 1}, reverse=True):
+                    try:
+                        newblocks = self.loadblocks(first, n)
+                        break
+                    except Exception as e:
+                        error = e
+            self.stats["read"] += time.perf_counter() - begin
+
+            if newblocks is None:
+                # fetchblocks raises this on the main thread
+                with self.read_cond:
+                    if self.read_next == first:
+                        self.read_error = error
+                    self.read_cond.notify_all()
+                continue
+
+            with self.read_cond:
+                for i, block in enumerate(newblocks):
+                    self.rawblocks[first + i] = block
+
+                # Don't move on if fetchblocks moved the reader while loading
+                if self.read_next == first:
+                    self.read_next = first + len(newblocks)
+
+                    if newblocks[-1] is None:
+                        self.read_eof = self.read_next - 1
+                        self.read_until = self.read_next
+
+                self.read_cond.notify_all()
+
+    def fetchblocks(self, blocknums, wait=True):
+        """ Take the raw data for blocks in blocknums that aren't cached from the
+            reader thread, returning a list of (blocknum, entry) to add to the
+            cache.  An entry of None means EOF.  If the loader raised an
+            exception reading a block that's waited for, it is raised here.
+
+            If wait is False, only blocks that have already been loaded are
+            returned, and the reader thread isn't moved.
+        """
+        missing = [b for b in blocknums if b not in self.blocks]
+
+        rv = []
+        if not len(missing):
+            return rv
+
+        begin = time.perf_counter()
+
+        with self.read_cond:
+            first = missing[0]
+
+            if wait:
+                if first not in self.rawblocks and not (
+                    self.read_next <= first <= self.read_next + self.readahead
+                ):
+                    # Not going to be read soon (i.e. seeking), so move the reader
+                    self.read_next = first
+                    self.read_eof = None
+                    self.read_error = None
+
+                self.read_until = max(self.read_next, missing[-1] + 1) + self.readahead
+
+                # Drop anything outside of the new window
+                for b in list(self.rawblocks.keys()):
+                    if b < first or b >= self.read_until:
+                        del self.rawblocks[b]
+
+                self.read_cond.notify_all()
+
+            for b in missing:
+                while (
+                    wait
+                    and b not in self.rawblocks
+                    and (self.read_eof is None or b < self.read_eof)
+                    and self.read_error is None
+                ):
+                    self.read_cond.wait()
+
+                if b in self.rawblocks:
+                    block = self.rawblocks.pop(b)
+                elif self.read_eof is not None and b >= self.read_eof:
+                    block = None
+                elif wait and self.read_error is not None:
+                    raise self.read_error
+                else:
+                    # Not loaded yet
+                    break
+
+                rv.append((b, block))
+                if block is None:
+                    break
+
+        if wait:
+            self.stats["read_wait"] += time.perf_counter() - begin
+
+        return rv
+
+    def readraw(self, sample, readlen):
+        """ Read samples directly from the loader, i.e. to copy the input out. """
+        with self.loader_lock:
+            return self.loader(self.infile, sample, readlen)
+
+    def demodrequest(self, blocknums, key):
+        """ Build a DEMOD request for the workers to demodulate blocknums as a
+            batch.  Where a shared memory slot is free, a block's arrays are
+            passed through it instead of pickled. """
+        requests = []
+        for blocknum in blocknums:
+            block = self.blocks[blocknum]
+            tosend = {
+                k: block[k] for k in ("rawinput", "rawsource", "fft") if k in block
+            }
+
+            slot = self.slots.alloc() if self.slots is not None else None
+            offset = 0
+            if slot is not None:
+                tosend, offset = self.slots.pack(slot, tosend)
+
+            requests.append((blocknum, tosend, slot, offset))
+
+        return ("DEMOD", requests, key)
+
+    def submit(self, blocknums, key):
+        """ Queue blocknums to be demodulated, in batches spread over the
+            workers, or with the serial backend demodulate them now.  Call with
+            self.lock held. """
+        batchsize = -(-len(blocknums) // max(len(self.threads), 1))
+        batchsize = int(np.clip(batchsize, 1, self.max_batch))
+
+        for i in range(0, len(blocknums), batchsize):
+            request = self.demodrequest(blocknums[i : i + batchsize], key)
+
+            if self.backend == "serial":
+                blocks = [r[1] for r in request[1]]
+                for r, output in zip(request[1], self.demodulate(blocks, key)):
+                    self.storeresult(r[0], output, None)
+            else:
+                self.q_in.put(request)
+
+    def doread(self, blocknums, MTF, dodemod=True, wait=True):
+        """ Load blocknums and queue any that need demodulating at MTF.  Returns
+            a list of events to wait on for blocks that aren't ready yet, or
+            None at EOF. """
         need_blocks = []
+        to_submit = []
+        key = self.demodkey(MTF)
 
-        hc = 0
+        newblocks = self.fetchblocks(blocknums, wait)
 
         self.lock.acquire()
 
+        for b, block in newblocks:
+            self.blocks[b] = block
+            self.updatebytes(b)
+
         for b in blocknums:
             if b not in self.blocks:
-                LRUupdate(self.lru, b)
-
-                rawdata = self.loader(self.infile, b * self.blocksize, self.rf.blocklen)
-
-                if rawdata is None or len(rawdata) < self.rf.blocklen:
-                    self.blocks[b] = None
-                    self.lock.release()
-                    return None
-
-                # ??? - I think I put it in to make sure it isn't erased for whatever reason, but might not be needed
-                rawdatac = rawdata.copy()
+                # Not loaded because an earlier block hit EOF, or not read yet
+                need_blocks = None
+                break
 
-                self.blocks[b] = {}
-                self.blocks[b]["rawinput"] = rawdatac
+            self.blocks.move_to_end(b)
 
             if self.blocks[b] is None:
-                self.lock.release()
-                return None
+                need_blocks = None
+                break
 
-            if dodemod:
-                handling = need_demod = ("demod" not in self.blocks[b]) or (
-                    np.abs(self.blocks[b]["MTF"] - MTF) > self.MTF_tolerance
+            if not dodemod and "rawinput" not in self.blocks[b]:
+                self.blocks[b]["rawinput"] = self.loader.finish(
+                    self.blocks[b].pop("rawsource")
                 )
-            else:
-                handling = need_demod = False
+                self.updatebytes(b)
+
+            need_demod = dodemod and key not in self.blocks[b].get("demod", {})
+
+            if need_demod and self.diskcache is not None:
+                demod = self.diskcache.load(key[0], b)
+                if demod is not None:
+                    self.setinput(b)
+                    self.blocks[b].setdefault("demod", {})[key] = demod
+                    self.updatebytes(b)
+                    self.stats["diskblocks"] += 1
+                    need_demod = False
 
-            # Check to see if it's already in queue to process
             if need_demod:
-                for inqueue in self.q_in_metadata:
-                    if inqueue[0] == b and (
-                        np.abs(inqueue[1] - MTF) <= self.MTF_tolerance
-                    ):
-                        handling = False
-                        # print(b)
+                # Check to see if it's already in queue to process
+                event = None
+                for inqueue_key, inqueue_event in self.pending.get(b, []):
+                    if inqueue_key == key:
+                        event = inqueue_event
+
+                if event is None:
+                    event = threading.Event()
+                    self.pending.setdefault(b, []).append((key, event))
+                    to_submit.append(b)
 
-                need_blocks.append(b)
+                need_blocks.append(event)
 
-            if handling:
-                self.q_in.put(("DEMOD", b, self.blocks[b], MTF))
-                self.q_in_metadata.append((b, MTF))
-                hc = hc + 1
+        # Submit what was found, even if EOF cut the loop short
+        self.submit(to_submit, key)
 
         self.lock.release()
 
         return need_blocks
 
+    def setinput(self, b):
+        """ Set the cut-down input for block b, resampling it first if needed """
+        block = self.blocks[b]
+
+        if "rawinput" not in block:
+            block["rawinput"] = self.loader.finish(block.pop("rawsource"))
+
+        if "input" not in block:
+            block["input"] = block["rawinput"][self.rf.blockcut : -self.rf.blockcut_end]
+
     def dequeue(self):
         # This is the thread's main loop - run until killed.
         while True:
@@ -1243,39 +2181,73 @@ class DemodCache:
                 return
 
             self.lock.acquire()
+            self.storeresult(*rv)
+            self.lock.release()
 
-            blocknum, item = rv
+    def storeresult(self, blocknum, item, slot):
+        """ Put a worker's output into the cache.  Call with self.lock held. """
+        if slot is not None:
+            item = self.slots.unpack(slot, item)
+            self.slots.release(slot)
 
-            if "MTF" not in item or "demod" not in item:
-                # This shouldn't happen, but was observed by Simon on a decode
-                logger.error(
-                    "incomplete demodulated block placed on queue, block #%d", blocknum
-                )
-                self.q_in.put((blocknum, self.blocks[blocknum], self.currentMTF))
-                self.lock.release()
-                continue
+        if "key" not in item or "demod" not in item:
+            # This shouldn't happen, but was observed by Simon on a decode
+            logger.error(
+                "incomplete demodulated block placed on queue, block #%d", blocknum
+            )
+            inqueue_key = self.pending[blocknum][0][0]
+            self.submit([blocknum], inqueue_key)
+            return
 
-            self.q_in_metadata.remove((blocknum, item["MTF"]))
+        event = None
+        pending = self.pending.get(blocknum, [])
+        for entry in pending:
+            if entry[0] == item["key"]:
+                event = entry[1]
+                pending.remove(entry)
+                break
 
-            for k in item.keys():
-                if k == "demod" and (
-                    np.abs(item["MTF"] - self.currentMTF) > self.MTF_tolerance
-                ):
-                    continue
-                self.blocks[blocknum][k] = item[k]
+        if not len(pending):
+            self.pending.pop(blocknum, None)
 
-            if "input" not in self.blocks[blocknum]:
-                self.blocks[blocknum]["input"] = self.blocks[blocknum]["rawinput"][
-                    self.rf.blockcut : -self.rf.blockcut_end
-                ]
+        self.stats["demod"] += item.pop("time", 0)
+        self.stats["blocks"] += 1
 
-            self.lock.release()
+        if self.blocks.get(blocknum) is None:
+            # Pruned from the cache while it was being demodulated
+            if event is not None:
+                event.set()
+            return
+
+        key = item.pop("key")
+        demod = item.pop("demod")
+        if key[1] == self.paramsversion:
+            self.blocks[blocknum].setdefault("demod", {})[key] = demod
+            if self.diskcache is not None:
+                self.diskcache.store(key[0], blocknum, demod)
+
+        for k in item.keys():
+            self.blocks[blocknum][k] = item[k]
+
+        self.blocks[blocknum].pop("rawsource", None)
+        self.setinput(blocknum)
+        self.updatebytes(blocknum)
+
+        # Wake up read() if it's waiting for this block
+        if event is not None:
+            event.set()
+
+    def read(self, begin, length, MTF=0, dodemod=True, products=None):
+        """ Return the demodulated output for length samples from begin, or
+            None at EOF.  products can ask for outputs (see
+            RFDecode.DEMOD_PRODUCTS) beyond rf.demod_products, which are then
+            demodulated for just these blocks. """
+        readstart = time.perf_counter()
 
-    def read(self, begin, length, MTF=0, dodemod=True):
         # transpose the cache by key, not block #
         t = {"input": [], "fft": [], "video": [], "audio": [], "efm": [], "rfhpf": []}
 
-        self.currentMTF = MTF
+        self.currentkey = self.demodkey(MTF)
 
         end = begin + length
 
@@ -1296,22 +2268,35 @@ class DemodCache:
             self.prune_cache()
             return rv
 
+        waitstart = time.perf_counter()
         while need_blocks is not None and len(need_blocks):
-            time.sleep(0.001)  # A crude busy loop
+            for event in need_blocks:
+                event.wait()
+
+            # Check again, as the result is dropped if the params changed meanwhile
             need_blocks = self.doread(toread, MTF)
+        self.stats["demod_wait"] += time.perf_counter() - waitstart
 
         if need_blocks is None:
             # EOF
             return None
 
+        if products is not None:
+            self.addproducts(toread, products)
+
         # Now coalesce the output
         for b in range(begin // self.blocksize, (end // self.blocksize) + 1):
+            demod = self.blocks[b]["demod"][self.currentkey]
             for k in t.keys():
-                if k in self.blocks[b]["demod"]:
-                    t[k].append(self.blocks[b]["demod"][k])
+                if k in demod:
+                    t[k].append(demod[k])
                 elif k in self.blocks[b]:
                     t[k].append(self.blocks[b][k])
 
+        if len(t["fft"]) != len(toread):
+            # prune_cache() has dropped the FFT of some of these blocks
+            t["fft"] = []
+
         self.prune_cache()
 
         rv = {}
@@ -1319,31 +2304,107 @@ class DemodCache:
             rv[k] = np.concatenate(t[k]) if len(t[k]) else None
 
         if rv["audio"] is not None:
+            blockaudio = len(rv["audio"]) // len(toread)
+            if self.audio_phase2 is None:
+                self.audio_phase2 = AudioPhase2(self.rf, align=blockaudio)
+
             rv["audio_phase1"] = rv["audio"]
-            rv["audio"] = self.rf.audio_phase2(rv["audio"])
+            rv["audio"] = self.audio_phase2.process(
+                rv["audio"], toread[0] * blockaudio
+            )
 
         rv["startloc"] = (begin // self.blocksize) * self.blocksize
 
-        need_blocks = self.doread(toread_prefetch, MTF)
+        self.adapt(toread[0], len(toread), readstart)
+
+        if self.backend != "serial":
+            need_blocks = self.doread(toread_prefetch, MTF, wait=False)
 
         return rv
 
+    def addproducts(self, blocknums, products):
+        """ Add products that blocknums' output at the current key doesn't have
+            yet, by demodulating them on their own and merging them in.  This
+            is for the odd extra product, so it runs here on the main thread. """
+        unknown = set(products) - set(self.rf.DEMOD_PRODUCTS)
+        if len(unknown):
+            raise ValueError("Unknown demod products: %s" % ", ".join(sorted(unknown)))
+
+        self.lock.acquire()
+
+        for b in blocknums:
+            block = self.blocks[b]
+            demod = block["demod"][self.currentkey]
+            missing = set(products) - set(demod["video"].dtype.names) - set(demod)
+            if self.rf.system != "PAL":
+                # Only PAL has a pilot signal
+                missing.discard("demod_pilot")
+            if not len(missing):
+                continue
+
+            if "fft" in block:
+                fftdata = block["fft"]
+            else:
+                if "rawinput" not in block:
+                    block["rawinput"] = self.loader.finish(block.pop("rawsource"))
+                fftdata = self.rf.blockfft(block["rawinput"])
+
+            extra = self.rf.demodblock(
+                fftdata=fftdata,
+                mtf_level=self.currentkey[0] * self.MTF_tolerance,
+                cut=True,
+                products=missing,
+            )
+
+            if "rfhpf" in missing:
+                demod["rfhpf"] = extra["rfhpf"]
+
+            video, extra_video = demod["video"], extra["video"]
+            names = [
+                k
+                for k in self.rf.DEMOD_PRODUCTS
+                if k in video.dtype.names or k in extra_video.dtype.names
+            ]
+            demod["video"] = np.rec.array(
+                [video[k] if k in video.dtype.names else extra_video[k] for k in names],
+                names=names,
+            )
+
+            self.updatebytes(b)
+
+        self.lock.release()
+
     def setparams(self, params):
-        # XXX: This should flush out the data, but right now this isn't used at all
+        """ Apply new decoder parameters.  Output demodulated with the old ones
+            is dropped, and anything still being demodulated with them will be
+            ignored. """
+        self.lock.acquire()
+
+        self.paramsversion += 1
+        self.currentkey = self.demodkey(self.currentkey[0] * self.MTF_tolerance)
+
         for p in self.threadpipes:
-            p[0].send(("NEWPARAMS", params))
+            p[0].send(("NEWPARAMS", params, self.paramsversion))
+
+        for b, block in self.blocks.items():
+            if block is not None and "demod" in block:
+                del block["demod"]
+                self.updatebytes(b)
 
         # Apply params to the core thread, so they match up with the decoders
         self.apply_newparams(params)
 
+        if self.diskcache is not None:
+            self.diskcache.sethash(self.rf)
+
+        self.lock.release()
 
-# Downscales to 16bit/44.1khz.  It might be nice when analog audio is better to support 24/96,
-# but if we only support one output type, matching CD audio/digital sound is greatly preferable.
+
+# Downscales to 16-bit audio at freq, which ld-decode defaults to 44.1khz.  Higher rates cost
+# little, but matching CD audio/digital sound is the preferable default.
 def downscale_audio(
     audio, lineinfo, rf, linecount, timeoffset=0, freq=48000.0, scale=64
 ):
-    failed = False
-
     frametime = linecount / (1000000 / rf.SysParams["line_period"])
     soundgap = 1 / freq
 
@@ -1352,67 +2413,79 @@ def downscale_audio(
     arange = np.arange(
         timeoffset, frametime + (soundgap / 2), soundgap, dtype=np.double
     )
-    locs = np.zeros(len(arange), dtype=np.float)
-    swow = np.zeros(len(arange), dtype=np.float)
-
-    for i, t in enumerate(arange):
-        linenum = ((t * 1000000) / rf.SysParams["line_period"]) + 1
-        intlinenum = int(linenum)
-
-        # XXX:
-        # The timing handling can sometimes go outside the bounds of the known line #'s.
-        # This is a quick-ish fix that should work OK but may affect quality slightly.
-        if linenum < 0:
-            lineloc_cur = int(lineinfo[0] + (rf.linelen * linenum))
-            lineloc_next = lineloc_cur + rf.linelen
-        elif len(lineinfo) > linenum + 2:
-            lineloc_cur, lineloc_next = lineinfo[intlinenum : intlinenum + 2]
-        else:
-            # Catch things that go past the last known line by using the last lines here.
-            lineloc_cur = lineinfo[-2]
-            lineloc_next = lineloc_cur + rf.linelen
-
-        sampleloc = lineloc_cur
-        sampleloc += (lineloc_next - lineloc_cur) * (linenum - np.floor(linenum))
-
-        swow[i] = (lineloc_next - lineloc_cur) / rf.linelen
-        swow[i] = ((swow[i] - 1)) + 1
-        # There's almost *no way* the disk is spinning more than 1.5% off, so mask TBC errors here
-        # to reduce pops
-        if i and np.abs(swow[i] - swow[i - 1]) > 0.015:
-            swow[i] = swow[i - 1]
 
-        locs[i] = sampleloc / scale
+    lineinfo = np.asarray(lineinfo, dtype=np.double)
+    linenum = ((arange * 1000000) / rf.SysParams["line_period"]) + 1
+    intlinenum = linenum.astype(np.int64)
 
-    output = np.zeros((2 * (len(arange) - 1)), dtype=np.int32)
-    output16 = np.zeros((2 * (len(arange) - 1)), dtype=np.int16)
+    # XXX:
+    # The timing handling can sometimes go outside the bounds of the known line #'s.
+    # This is a quick-ish fix that should work OK but may affect quality slightly.
+    # Catch things that go past the last known line by using the last lines here.
+    lineloc_cur = np.full(len(arange), lineinfo[-2])
 
-    for i in range(len(arange) - 1):
-        start = np.int(locs[i])
-        end = np.int(locs[i + 1])
-        if end > start and end < len(audio["audio_left"]):
-            output_left = nb_mean(audio["audio_left"][start:end])
-            output_right = nb_mean(audio["audio_right"][start:end])
+    before = linenum < 0
+    lineloc_cur[before] = np.trunc(lineinfo[0] + (rf.linelen * linenum[before]))
 
-            output_left = (output_left * swow[i]) - rf.SysParams["audio_lfreq"]
-            output_right = (output_right * swow[i]) - rf.SysParams["audio_rfreq"]
+    known = ~before & (len(lineinfo) > linenum + 2)
+    lineloc_cur[known] = lineinfo[intlinenum[known]]
 
-            output[(i * 2) + 0] = dsa_rescale(output_left)
-            output[(i * 2) + 1] = dsa_rescale(output_right)
-        else:
-            # TBC failure can cause this (issue #389)
-            if failed == False:
-                logger.warning("Analog audio processing error, muting samples")
+    lineloc_next = lineloc_cur + rf.linelen
+    lineloc_next[known] = lineinfo[intlinenum[known] + 1]
 
-            failed = True
+    sampleloc = lineloc_cur + (
+        (lineloc_next - lineloc_cur) * (linenum - np.floor(linenum))
+    )
+    locs = sampleloc / scale
 
-    np.clip(output, -32766, 32766, out=output16)
+    swow = (lineloc_next - lineloc_cur) / rf.linelen
+    swow = ((swow - 1)) + 1
+
+    # There's almost *no way* the disk is spinning more than 1.5% off, so mask TBC errors here
+    # to reduce pops.  Each value is held over the next until it's back in range.
+    held = 0
+    for i in np.flatnonzero(np.abs(np.diff(swow)) > 0.015) + 1:
+        if i <= held:
+            # Already compared against the held value
+            continue
+
+        while i < len(swow) and np.abs(swow[i] - swow[i - 1]) > 0.015:
+            swow[i] = swow[i - 1]
+            i += 1
+        held = i
+
+    # Average the audio between each pair of locations
+    start = locs[:-1].astype(np.int64)
+    end = locs[1:].astype(np.int64)
+    valid = (end > start) & (start >= 0) & (end < len(audio["audio_left"]))
+
+    output = np.zeros((len(arange) - 1, 2), dtype=np.int32)
+
+    channels = [("audio_left", "audio_lfreq"), ("audio_right", "audio_rfreq")]
+    for i, (name, freqname) in enumerate(channels):
+        csum = np.concatenate(([0], np.cumsum(audio[name])))
+        means = (csum[end[valid]] - csum[start[valid]]) / (end - start)[valid]
+
+        output[valid, i] = dsa_rescale(
+            (means * swow[:-1][valid]) - rf.SysParams[freqname]
+        )
+
+    if not np.all(valid):
+        # TBC failure can cause this (issue #389)
+        logger.warning("Analog audio processing error, muting samples")
+
+    output16 = np.clip(output.ravel(), -32766, 32766).astype(np.int16)
 
     return output16, arange[-1] - frametime
 
 
 # The Field class contains common features used by NTSC and PAL
 class Field:
+    # Demodulated outputs (see RFDecode.DEMOD_PRODUCTS) used to process fields,
+    # and the extra ones used for dropout detection
+    demod_products = {"demod", "demod_05", "demod_burst"}
+    dropout_products = {"demod_raw", "rfhpf"}
+
     def __init__(
         self, rf, decode, audio_offset=0, keepraw=True, prevfield=None, initphase=False
     ):
@@ -1448,6 +2521,20 @@ class Field:
         # this is eventually set to 262/263 and 312/313 for audio timing
         self.linecount = None
 
+        self.keep_levels()
+
+    def keep_levels(self):
+        """ Keep rf's current IRE levels for iretohz/hztoire.  The AGC can change
+            rf's while this field's dropout and metrics tasks are running. """
+        self.ire0 = self.rf.SysParams["ire0"]
+        self.hz_ire = self.rf.SysParams["hz_ire"]
+
+    def iretohz(self, ire):
+        return self.ire0 + (self.hz_ire * ire)
+
+    def hztoire(self, hz):
+        return (hz - self.ire0) / self.hz_ire
+
     def process(self):
         self.linelocs1, self.linebad, self.nextfieldoffset = self.compute_linelocs()
         if self.linelocs1 is None:
@@ -2559,10 +3646,10 @@ class Field:
 
         # build sets of min/max valid levels
         valid_min = np.full_like(
-            f.data["video"]["demod"], f.rf.iretohz(-60 if isPAL else -50)
+            f.data["video"]["demod"], f.iretohz(-60 if isPAL else -50)
         )
         valid_max = np.full_like(
-            f.data["video"]["demod"], f.rf.iretohz(150 if isPAL else 160)
+            f.data["video"]["demod"], f.iretohz(150 if isPAL else 160)
         )
 
         # the minimum valid value during VSYNC is lower for PAL because of the pilot signal
@@ -2571,8 +3658,8 @@ class Field:
         iserr2 = f.data["video"]["demod"] < valid_min
         iserr2 |= f.data["video"]["demod"] > valid_max
 
-        valid_min05 = np.full_like(f.data["video"]["demod_05"], f.rf.iretohz(-20))
-        valid_max05 = np.full_like(f.data["video"]["demod_05"], f.rf.iretohz(115))
+        valid_min05 = np.full_like(f.data["video"]["demod_05"], f.iretohz(-20))
+        valid_max05 = np.full_like(f.data["video"]["demod_05"], f.iretohz(115))
 
         iserr3 = f.data["video"]["demod_05"] < valid_min05
         iserr3 |= f.data["video"]["demod_05"] > valid_max05
@@ -2752,6 +3839,8 @@ class Field:
 
 
 class FieldPAL(Field):
+    demod_products = Field.demod_products | {"demod_pilot"}
+
     def refine_linelocs_pilot(self, linelocs=None):
         if linelocs is None:
             linelocs = self.linelocs2.copy()
@@ -3177,7 +4266,7 @@ class LDdecode:
 
         self.branch, self.commit = get_git_info()
 
-        self.infile = open(fname_in, "rb")
+        self.infile = open_input(fname_in)
         self.freader = freader
 
         self.est_frames = est_frames
@@ -3188,7 +4277,7 @@ class LDdecode:
 
         self.blackIRE = 0
 
-        self.analog_audio = int(analog_audio * 1000)
+        self.analog_audio = int(round(analog_audio * 1000))
         self.digital_audio = digital_audio
         self.write_rf_tbc = extra_options.get("write_RF_TBC", False)
 
@@ -3262,10 +4351,25 @@ class LDdecode:
 
         self.doDOD = doDOD
 
+        # Only demodulate what fields and dropout detection will use
+        self.rf.demod_products = set(self.FieldClass.demod_products)
+        if self.doDOD:
+            self.rf.demod_products |= self.FieldClass.dropout_products
+
         self.badfields = None
 
         self.fieldinfo = []
 
+        # Dropout detection and metrics for each field are done on field_pool,
+        # and its output is written in order on output_pool, while the next
+        # field is being decoded.  field_tasks has the outstanding work.
+        self.field_pool, self.output_pool = None, None
+        field_threads = extra_options.get("field_threads", 2)
+        if field_threads and extra_options.get("backend") != "serial":
+            self.field_pool = ThreadPoolExecutor(max_workers=field_threads)
+            self.output_pool = ThreadPoolExecutor(max_workers=1)
+        self.field_tasks = []
+
         self.leadIn = False
         self.leadOut = False
         self.isCLV = False
@@ -3277,7 +4381,13 @@ class LDdecode:
         self.verboseVITS = False
 
         self.demodcache = DemodCache(
-            self.rf, self.infile, self.freader, num_worker_threads=self.numthreads
+            self.rf,
+            self.infile,
+            self.freader,
+            num_worker_threads=self.numthreads,
+            cache_mb=extra_options.get("cache_mb"),
+            demod_cache=extra_options.get("demod_cache"),
+            backend=extra_options.get("backend", "process"),
         )
 
         self.bw_ratios = []
@@ -3288,6 +4398,12 @@ class LDdecode:
     def close(self):
         """ deletes all open files, so it's possible to pickle an LDDecode object """
 
+        self.flush_field_tasks()
+        for pool in (self.field_pool, self.output_pool):
+            if pool is not None:
+                pool.shutdown()
+        self.field_pool, self.output_pool = None, None
+
         try:
             self.ffmpeg_rftbc.kill()
         except:
@@ -3304,6 +4420,17 @@ class LDdecode:
         ]:
             setattr(self, outfiles, None)
 
+        stats = self.demodcache.stats
+        logger.info(
+            "Reading input took %.1fs (%.1fs waiting), demodulation %.1fs (%.1fs waiting)",
+            stats["read"],
+            stats["read_wait"],
+            stats["demod"],
+            stats["demod_wait"],
+        )
+        if stats["diskblocks"]:
+            logger.info("%d blocks loaded from the demod cache", stats["diskblocks"])
+
         self.demodcache.end()
 
     def roughseek(self, location, isField=True):
@@ -3353,22 +4480,49 @@ class LDdecode:
 
         return np.median(sync_hzs), np.median(ire0_hzs)
 
+    def queue_field_task(self, pool, func, *args):
+        """ Run func on pool, or right away if pipelining is off.  Errors are
+            raised when the task is waited for by flush_field_tasks(). """
+        if pool is None:
+            func(*args)
+            return
+
+        self.field_tasks.append(pool.submit(func, *args))
+
+        # Don't let more than a few fields' worth of work build up
+        while len(self.field_tasks) > 16:
+            self.field_tasks.pop(0).result()
+
+    def flush_field_tasks(self):
+        """ Wait for all queued field metadata and output to be done """
+        while len(self.field_tasks):
+            self.field_tasks.pop(0).result()
+
     def writeout(self, dataset):
         f, fi, picture, audio, efm = dataset
 
+        fi["audioSamples"] = 0 if audio is None else int(len(audio) / 2)
+        fi.setdefault("efmTValues", 0)
+
+        self.fieldinfo.append(fi)
+        self.fields_written += 1
+
+        self.queue_field_task(self.output_pool, self.writefield, dataset)
+
+    def writefield(self, dataset):
+        """ Write a field's output.  The EFM PLL keeps state between fields, so
+            these have to be run in order. """
+        f, fi, picture, audio, efm = dataset
+
         if self.digital_audio == True:
             if self.outfile_pre_efm is not None:
                 self.outfile_pre_efm.write(efm.tobytes())
             efm_out = self.efm_pll.process(efm)
             self.outfile_efm.write(efm_out.tobytes())
 
-        fi["audioSamples"] = 0 if audio is None else int(len(audio) / 2)
         fi["efmTValues"] = len(efm_out) if self.digital_audio else 0
 
-        self.fieldinfo.append(fi)
-
         self.outfile_video.write(picture)
-        self.fields_written += 1
 
         if self.outfile_rftbc is not None or self.pipe_rftbc is not None:
             rftbc = f.rf_tbc()
@@ -3478,7 +4632,8 @@ class LDdecode:
                         self.rf.SysParams["hz_ire"] = (sync_hz - ire0_hz) / vsync_ire
 
                 if adjusted == False and redo == True:
-                    self.demodcache.flush_demod()
+                    # Demodulated blocks are cached per MTF level, so this only
+                    # demodulates again if the MTF level has changed
                     adjusted = True
                     self.fdoffset -= offset
                 else:
@@ -3706,7 +4861,7 @@ class LDdecode:
         bl_sliceraw = slice(bl_slice.start - delay, bl_slice.stop - delay)
         metrics["blackLineRFLevel"] = np.std(f.rawdata[bl_sliceraw])
 
-        metrics["blackLinePreTBCIRE"] = f.rf.hztoire(
+        metrics["blackLinePreTBCIRE"] = f.hztoire(
             np.mean(f.data["video"]["demod"][bl_slice])
         )
         metrics["blackLinePostTBCIRE"] = f.output_to_ire(
@@ -3754,14 +4909,13 @@ class LDdecode:
             "medianBurstIRE": roundfloat(f.burstmedian),
         }
 
+        # The tasks below use the levels as of now, before the AGC changes them
+        f.keep_levels()
+
         if self.doDOD:
-            dropout_lines, dropout_starts, dropout_ends = f.dropout_detect()
-            if len(dropout_lines):
-                fi["dropOuts"] = {
-                    "fieldLine": dropout_lines,
-                    "startx": dropout_starts,
-                    "endx": dropout_ends,
-                }
+            # Filled in by dropout_task, which removes it if there are none
+            fi["dropOuts"] = None
+            self.queue_field_task(self.field_pool, self.dropout_task, f, fi)
 
         # This is a bitmap, not a counter
         decodeFaults = 0
@@ -3796,7 +4950,10 @@ class LDdecode:
                     return fi, True
 
         fi["decodeFaults"] = decodeFaults
-        fi["vitsMetrics"] = self.computeMetrics(self.curfield, self.prevfield)
+        fi["vitsMetrics"] = None
+        self.queue_field_task(
+            self.field_pool, self.metrics_task, fi, self.curfield, self.prevfield
+        )
 
         fi["vbi"] = {"vbiData": [int(lc) for lc in f.linecode if lc is not None]}
 
@@ -3865,6 +5022,20 @@ class LDdecode:
 
         return fi, False
 
+    def dropout_task(self, f, fi):
+        dropout_lines, dropout_starts, dropout_ends = f.dropout_detect()
+        if len(dropout_lines):
+            fi["dropOuts"] = {
+                "fieldLine": dropout_lines,
+                "startx": dropout_starts,
+                "endx": dropout_ends,
+            }
+        else:
+            del fi["dropOuts"]
+
+    def metrics_task(self, fi, f, fp):
+        fi["vitsMetrics"] = self.computeMetrics(f, fp)
+
     def seek_getframenr(self, startfield):
         """ Reads from file location startfield, returns first VBI frame # or None on failure and revised startfield """
 
@@ -3915,6 +5086,10 @@ class LDdecode:
 
     def seek(self, startframe, target):
         """ Attempts to find frame target from file location startframe """
+        if not self.infile.seekable():
+            logger.error("Seeking to a frame number is not supported on streamed input")
+            return None
+
         logger.info("Beginning seek")
 
         if not sys.warnoptions:
@@ -3942,6 +5117,8 @@ class LDdecode:
 
     def build_json(self, f):
         """ build up the JSON structure for file output. """
+        self.flush_field_tasks()
+
         jout = {}
         jout["pcmAudioParameters"] = {
             "bits": 16,
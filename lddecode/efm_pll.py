@@ -29,12 +29,6 @@ import sys
 
 import scipy.interpolate as spi
 
-try:
-    from numba.experimental import jitclass
-except ImportError:
-    # Prior to numba 0.49
-    from numba import jitclass
-
 def computeefmfilter(freq_hz = 40000000, blocklen = 65536):
     """Frequency-domain equalisation filter for the LaserDisc EFM signal.
     This was inspired by the input signal equaliser in WSJT-X, described in
@@ -76,155 +70,170 @@ def computeefmfilter(freq_hz = 40000000, blocklen = 65536):
 
     return coeffs * 8
 
-# Attribute types of EFM_PLL for numba.
-EFM_PLL_spec = [
-    ("zcPreviousInput", numba.int16),
-    ("delta", numba.float64),
-    ("pllResult", numba.int8[:]),
-    ("pllResultCount", numba.uintp),
-    ("basePeriod", numba.float64),
-    ("minimumPeriod", numba.float64),
-    ("maximumPeriod", numba.float64),
-    ("periodAdjustBase", numba.float64),
-    ("currentPeriod", numba.float64),
-    ("phaseAdjust", numba.float64),
-    ("refClockTime", numba.float64),
-    ("frequencyHysteresis", numba.int32),
-    ("tCounter", numba.int8),
-]
-
-
-@jitclass(EFM_PLL_spec)
-class EFM_PLL:
-    def __init__(self):
-        # ZC detector state
-        self.zcPreviousInput = 0
-        self.delta = 0.0
+# T1 clock period: 40MSPS / bit-rate
+basePeriod = 40000000.0 / 4321800.0
 
-        # PLL output buffer
-        self.pllResult = np.empty(1 << 16, np.int8)
-        self.pllResultCount = 0
+minimumPeriod = basePeriod * 0.90  # -10% minimum
+maximumPeriod = basePeriod * 1.10  # +10% maximum
+periodAdjustBase = basePeriod * 0.0001  # Clock adjustment step
 
-        # PLL state
-        self.basePeriod = 40000000.0 / 4321800.0  # T1 clock period 40MSPS / bit-rate
+# The PLL's state is kept between buffers in a small float64 array, with
+# these indexes
+ZC_PREVIOUS_INPUT = 0
+DELTA = 1
+CURRENT_PERIOD = 2
+PHASE_ADJUST = 3
+REF_CLOCK_TIME = 4
+FREQUENCY_HYSTERESIS = 5
+T_COUNTER = 6
+STATE_SIZE = 7
 
-        self.minimumPeriod = self.basePeriod * 0.90  # -10% minimum
-        self.maximumPeriod = self.basePeriod * 1.10  # +10% maximum
-        self.periodAdjustBase = self.basePeriod * 0.0001  # Clock adjustment step
 
-        # PLL Working parameters
-        self.currentPeriod = self.basePeriod
-        self.phaseAdjust = 0.0
-        self.refClockTime = 0.0
-        self.frequencyHysteresis = 0
-        self.tCounter = 1
+def new_state():
+    """Initial state for efm_pll_process."""
+    state = np.zeros(STATE_SIZE, np.float64)
+    state[CURRENT_PERIOD] = basePeriod
+    state[T_COUNTER] = 1
 
-    def process(self, inputBuffer):
-        """This method performs interpolated zero-crossing detection and stores
-        the result as sample deltas (the number of samples between each
-        zero-crossing).  Interpolation of the zero-crossing point provides a
-        result with sub-sample resolution.
+    return state
 
-        Since the EFM data is NRZ-I (non-return to zero inverted) the polarity
-        of the input signal is not important (only the frequency); therefore we
-        can simply store the delta information.  The resulting delta
-        information is fed to the phase-locked loop which is responsible for
-        correcting jitter errors from the ZC detection process.
 
-        inputBuffer is a numpy.ndarray of np.int16 samples.
-        Returns a view into a numpy.ndarray of np.int8 times."""
+@numba.njit(cache=True, nogil=True)
+def efm_pll_process(state, inputBuffer, pllResult):
+    """This performs interpolated zero-crossing detection, and feeds the
+    sample deltas (the number of samples between each zero-crossing) to the
+    phase-locked loop which is responsible for correcting jitter errors from
+    the ZC detection process.  Interpolation of the zero-crossing point
+    provides a result with sub-sample resolution.
 
-        #print(len(inputBuffer), min(inputBuffer), max(inputBuffer))
+    Since the EFM data is NRZ-I (non-return to zero inverted) the polarity
+    of the input signal is not important (only the frequency).
 
-        # Ensure the PLL result buffer is big enough, and clear it
-        if len(self.pllResult) < len(inputBuffer):
-            self.pllResult = np.empty(len(inputBuffer), np.int8)
-        self.pllResultCount = 0
+    state is updated in place.  The T values are written to pllResult, which
+    must be at least as long as inputBuffer, and the count is returned."""
 
-        for curr in inputBuffer:
-            prev = self.zcPreviousInput
+    # Work on local copies of the state, so they can stay in registers
+    zcPreviousInput = np.int64(state[ZC_PREVIOUS_INPUT])
+    delta = state[DELTA]
+    currentPeriod = state[CURRENT_PERIOD]
+    phaseAdjust = state[PHASE_ADJUST]
+    refClockTime = state[REF_CLOCK_TIME]
+    frequencyHysteresis = np.int64(state[FREQUENCY_HYSTERESIS])
+    tCounter = np.int64(state[T_COUNTER])
 
-            # Have we seen a zero-crossing?
-            if (prev < 0 and curr >= 0) or (prev >= 0 and curr < 0):
-                # Interpolate to get the ZC sub-sample position fraction
-                fraction = (-prev) / (curr - prev)
+    pllResultCount = 0
 
-                # Feed the sub-sample accurate result to the PLL
-                self.pushEdge(self.delta + fraction)
+    for i in range(len(inputBuffer)):
+        curr = np.int64(inputBuffer[i])
+        prev = zcPreviousInput
 
-                # Offset the next delta by the fractional part of the result
-                # in order to maintain accuracy
-                self.delta = 1.0 - fraction
-            else:
-                # No ZC, increase delta by 1 sample
-                self.delta += 1.0
+        # Keep the previous input (so we can work across buffer boundaries)
+        zcPreviousInput = curr
+
+        # Have we seen a zero-crossing?
+        if not ((prev < 0 and curr >= 0) or (prev >= 0 and curr < 0)):
+            # No ZC, increase delta by 1 sample
+            delta += 1.0
+            continue
 
-            # Keep the previous input (so we can work across buffer boundaries)
-            self.zcPreviousInput = curr
+        # Interpolate to get the ZC sub-sample position fraction
+        fraction = (-prev) / (curr - prev)
 
-        return self.pllResult[: self.pllResultCount]
+        # Feed the sub-sample accurate result to the PLL
+        sampleDelta = delta + fraction
 
-    def pushEdge(self, sampleDelta):
-        """Called when a ZC happens on a sample number."""
+        # Offset the next delta by the fractional part of the result
+        # in order to maintain accuracy
+        delta = 1.0 - fraction
 
-        while sampleDelta >= self.refClockTime:
-            nextTime = self.refClockTime + self.currentPeriod + self.phaseAdjust
-            self.refClockTime = nextTime
+        while sampleDelta >= refClockTime:
+            nextTime = refClockTime + currentPeriod + phaseAdjust
+            refClockTime = nextTime
 
             # Note: the tCounter < 3 check causes an 'edge push' if T is 1 or 2 (which
             # are invalid timing lengths for the NRZI data).  We also 'edge pull' values
             # greater than T11
-            if (sampleDelta > nextTime or self.tCounter < 3) and self.tCounter < 11:
-                self.phaseAdjust = 0.0
-                self.tCounter += 1
+            if (sampleDelta > nextTime or tCounter < 3) and tCounter < 11:
+                phaseAdjust = 0.0
+                tCounter += 1
             else:
-                edgeDelta = sampleDelta - (nextTime - self.currentPeriod / 2.0)
-                self.phaseAdjust = edgeDelta * 0.005
+                edgeDelta = sampleDelta - (nextTime - currentPeriod / 2.0)
+                phaseAdjust = edgeDelta * 0.005
 
                 # Adjust frequency based on error
                 if edgeDelta < 0:
-                    if self.frequencyHysteresis < 0:
-                        self.frequencyHysteresis -= 1
+                    if frequencyHysteresis < 0:
+                        frequencyHysteresis -= 1
                     else:
-                        self.frequencyHysteresis = -1
+                        frequencyHysteresis = -1
                 elif edgeDelta > 0:
-                    if self.frequencyHysteresis > 0:
-                        self.frequencyHysteresis += 1
+                    if frequencyHysteresis > 0:
+                        frequencyHysteresis += 1
                     else:
-                        self.frequencyHysteresis = 1
+                        frequencyHysteresis = 1
                 else:
-                    self.frequencyHysteresis = 0
+                    frequencyHysteresis = 0
 
                 # Update the reference clock?
-                if self.frequencyHysteresis < -1.0 or self.frequencyHysteresis > 1.0:
-                    aper = self.periodAdjustBase * edgeDelta / self.currentPeriod
+                if frequencyHysteresis < -1 or frequencyHysteresis > 1:
+                    aper = periodAdjustBase * edgeDelta / currentPeriod
 
                     # If there's been a substantial gap since the last edge (e.g.
                     # a dropout), edgeDelta can be very large here, so we need to
                     # limit how much of an adjustment we're willing to make
-                    if aper < -self.periodAdjustBase:
-                        aper = -self.periodAdjustBase
-                    elif aper > self.periodAdjustBase:
-                        aper = self.periodAdjustBase
+                    if aper < -periodAdjustBase:
+                        aper = -periodAdjustBase
+                    elif aper > periodAdjustBase:
+                        aper = periodAdjustBase
 
-                    self.currentPeriod += aper
+                    currentPeriod += aper
 
-                    if self.currentPeriod < self.minimumPeriod:
-                        self.currentPeriod = self.minimumPeriod
-                    elif self.currentPeriod > self.maximumPeriod:
-                        self.currentPeriod = self.maximumPeriod
+                    if currentPeriod < minimumPeriod:
+                        currentPeriod = minimumPeriod
+                    elif currentPeriod > maximumPeriod:
+                        currentPeriod = maximumPeriod
 
-                self.pllResult[self.pllResultCount] = self.tCounter
-                self.pllResultCount += 1
+                pllResult[pllResultCount] = tCounter
+                pllResultCount += 1
 
-                self.tCounter = 1
+                tCounter = 1
 
         # Reset refClockTime ready for the next delta but
         # keep any error to maintain accuracy
-        self.refClockTime -= sampleDelta
+        refClockTime -= sampleDelta
+
+    state[ZC_PREVIOUS_INPUT] = zcPreviousInput
+    state[DELTA] = delta
+    state[CURRENT_PERIOD] = currentPeriod
+    state[PHASE_ADJUST] = phaseAdjust
+    state[REF_CLOCK_TIME] = refClockTime
+    state[FREQUENCY_HYSTERESIS] = frequencyHysteresis
+    state[T_COUNTER] = tCounter
+
+    return pllResultCount
+
+
+class EFM_PLL:
+    def __init__(self):
+        self.state = new_state()
+
+        # PLL output buffer
+        self.pllResult = np.empty(1 << 16, np.int8)
+
+    def process(self, inputBuffer):
+        """Run the PLL over inputBuffer, a numpy.ndarray of np.int16 samples.
+        Returns a view into a numpy.ndarray of np.int8 times, which is reused
+        by the next call."""
+
+        inputBuffer = np.asarray(inputBuffer, dtype=np.int16)
+
+        # Ensure the PLL result buffer is big enough
+        if len(self.pllResult) < len(inputBuffer):
+            self.pllResult = np.empty(len(inputBuffer), np.int8)
+
+        count = efm_pll_process(self.state, inputBuffer, self.pllResult)
 
-        # Use this debug if you want to monitor the PLL output frequency
-        # print("Base =", self.basePeriod, "current = ", self.currentPeriod, file=sys.stderr)
+        return self.pllResult[:count]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,210 @@
+# FFTs for ld-decode and vhs-decode.
+#
+# This stands in for numpy.fft (fft, ifft, rfft and irfft over the last axis),
+# so modules import it as npfft.  With pyFFTW, each thread keeps its own FFTW
+# plans and aligned buffers, so plans aren't rebuilt when they go idle and
+# worker threads never share a plan's arrays.  Plans for the sizes given to
+# prepare() are measured, and the FFTW wisdom from that is saved to a cache
+# file (after prepare() and at exit) so later runs don't measure again.  Without pyFFTW, scipy.fft is used.
+
+from collections import OrderedDict
+import atexit
+import os
+import tempfile
+import threading
+
+import numpy as np
+import scipy.fft
+
+try:
+    import pyfftw
+except ImportError:
+    pyfftw = None
+
+# Worker threads for each scipy.fft call.  Decoding already runs a worker per
+# core, so this is normally left at 1.
+workers = 1
+
+# Plans kept per thread, least recently used dropped first
+max_plans = 64
+
+wisdom_file = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "ld-decode",
+    "fftw_wisdom",
+)
+
+# Transform lengths that get measured (rather than estimated) plans
+_measured = set()
+_local = threading.local()
+_wisdom_lock = threading.Lock()
+# The wisdom last loaded or saved, so it's only written out when it changes
+_saved_wisdom = None
+
+
+def load_wisdom():
+    """ Load saved FFTW wisdom, if there is any. """
+    if pyfftw is None:
+        return
+
+    global _saved_wisdom
+
+    try:
+        with open(wisdom_file, "rb") as fp:
+            wisdom = tuple(fp.read().split(b"\0"))
+        pyfftw.import_wisdom(wisdom)
+    except (OSError, ValueError, TypeError):
+        pass
+
+    _saved_wisdom = pyfftw.export_wisdom()
+
+
+def save_wisdom():
+    """ Save FFTW's wisdom if it has changed, replacing the file so other
+        processes never see it half written. """
+    global _saved_wisdom
+
+    if pyfftw is None:
+        return
+
+    with _wisdom_lock:
+        wisdom = pyfftw.export_wisdom()
+        if wisdom == _saved_wisdom:
+            return
+
+        try:
+            dirname = os.path.dirname(wisdom_file)
+            os.makedirs(dirname, exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(dir=dirname)
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(b"\0".join(wisdom))
+            os.replace(tmpname, wisdom_file)
+            _saved_wisdom = wisdom
+        except OSError:
+            pass
+
+
+def empty_aligned(shape, dtype=np.float64):
+    """ An uninitialised array aligned for SIMD use by FFTW """
+    if pyfftw is None:
+        return np.empty(shape, dtype=dtype)
+
+    return pyfftw.empty_aligned(shape, dtype=dtype)
+
+
+# Input and output dtypes, and direction, of each kind of transform
+_kinds = {
+    "fft": (np.complex128, np.complex128, "FFTW_FORWARD"),
+    "ifft": (np.complex128, np.complex128, "FFTW_BACKWARD"),
+    "rfft": (np.float64, np.complex128, "FFTW_FORWARD"),
+    "irfft": (np.complex128, np.float64, "FFTW_BACKWARD"),
+}
+
+
+def _getplan(kind, shape, n):
+    """ This thread's plan for a transform of length n over the last axis of
+        an array of shape (which is the plan's input shape). """
+    plans = _local.__dict__.setdefault("plans", OrderedDict())
+
+    key = (kind, shape, n)
+    plan = plans.get(key)
+    if plan is not None:
+        plans.move_to_end(key)
+        return plan
+
+    indtype, outdtype, direction = _kinds[kind]
+    outshape = shape[:-1] + ((n // 2) + 1 if kind == "rfft" else n,)
+
+    measure = n in _measured
+    flags = ("FFTW_MEASURE" if measure else "FFTW_ESTIMATE",)
+
+    # The plan's input is switched to each caller's array where possible, so
+    # it has a buffer of its own for inputs that have to be copied or padded
+    inbuf = pyfftw.empty_aligned(shape, dtype=indtype)
+    plan = pyfftw.FFTW(
+        inbuf,
+        pyfftw.empty_aligned(outshape, dtype=outdtype),
+        axes=(-1,),
+        direction=direction,
+        flags=flags,
+        threads=1,
+    )
+
+    plans[key] = (plan, inbuf)
+    if len(plans) > max_plans:
+        plans.popitem(last=False)
+
+    return plan, inbuf
+
+
+def _transform(kind, a, n, axis):
+    a = np.asarray(a)
+
+    if pyfftw is None or axis not in (-1, a.ndim - 1):
+        func = getattr(scipy.fft, kind)
+        # Keep numpy's double precision, which scipy.fft doesn't for float32
+        a = a.astype(_kinds[kind][0], copy=False)
+        return func(a, n=n, axis=axis, workers=workers)
+
+    if n is None:
+        n = 2 * (a.shape[-1] - 1) if kind == "irfft" else a.shape[-1]
+
+    inlen = (n // 2) + 1 if kind == "irfft" else n
+    plan, inbuf = _getplan(kind, a.shape[:-1] + (inlen,), n)
+
+    out = pyfftw.empty_aligned(plan.output_shape, dtype=plan.output_dtype)
+
+    if (
+        a.shape[-1] == inlen
+        and kind != "irfft"
+        and a.dtype == plan.input_dtype
+        and a.flags.c_contiguous
+        and pyfftw.is_byte_aligned(a, plan.input_alignment)
+    ):
+        # Transform the caller's array in place of the plan's buffer
+        return plan(a, out)
+
+    # Anything else is copied into the plan's own buffer, padded or truncated
+    # to n.  irfft always copies, since FFTW overwrites the input of
+    # complex-to-real transforms.
+    length = min(inlen, a.shape[-1])
+    inbuf[..., :length] = a[..., :length]
+    inbuf[..., length:] = 0
+    return plan(inbuf, out)
+
+
+def fft(a, n=None, axis=-1):
+    return _transform("fft", a, n, axis)
+
+
+def ifft(a, n=None, axis=-1):
+    return _transform("ifft", a, n, axis)
+
+
+def rfft(a, n=None, axis=-1):
+    return _transform("rfft", a, n, axis)
+
+
+def irfft(a, n=None, axis=-1):
+    return _transform("irfft", a, n, axis)
+
+
+def prepare(sizes):
+    """ Build (and measure) plans for single blocks of each transform length
+        in sizes, so that decoding doesn't stop to plan them later.  Batches of
+        blocks of these lengths also get measured plans when first used. """
+    if pyfftw is None:
+        return
+
+    for n in sizes:
+        _measured.add(n)
+        for kind in ("fft", "ifft", "rfft"):
+            _getplan(kind, (n,), n)
+        _getplan("irfft", ((n // 2) + 1,), n)
+
+    save_wisdom()
+
+
+load_wisdom()
+# For plans measured after prepare(), i.e. for batches of blocks
+atexit.register(save_wisdom)
@@ -4,16 +4,20 @@ import atexit
 from base64 import b64encode
 from collections import namedtuple
 import copy
+from fractions import Fraction
 import getopt
 import io
 from io import BytesIO
 import json
 import math
+import mmap
 import os
+import stat
 import sys
 import subprocess
 
 from multiprocessing import Process, Pool, Queue, JoinableQueue, Pipe
+from multiprocessing import shared_memory
 import threading
 import queue
 
@@ -96,54 +100,56 @@ Returns data if successful, or None or an upstream exception if not (including i
 """
 
 
-def make_loader(filename, inputfreq=None):
+def make_loader(filename, inputfreq=None, input_format=None):
     """Return an appropriate loader function object for filename.
 
     If inputfreq is specified, it gives the sample rate in MHz of the source
-    file, and the loader will resample from that rate to 40 MHz. Any sample
-    rate specified by the source file's metadata will be ignored, as some
-    formats can't represent typical RF sample rates accurately."""
-
-    if inputfreq is not None:
-        # We're resampling, so we have to use ffmpeg.
-
-        if filename.endswith(".s16"):
-            input_args = ["-f", "s16le"]
-        elif filename.endswith(".r16") or filename.endswith(".u16"):
-            input_args = ["-f", "u16le"]
-        elif filename.endswith(".rf"):
-            input_args = ["-f", "f32le"]
-        elif filename.endswith(".r8") or filename.endswith(".u8"):
-            input_args = ["-f", "u8"]
-        elif filename.endswith(".u16"):
-            input_args = ["-f", "u16le"]
-        elif filename.endswith(".lds") or filename.endswith(".r30"):
-            raise ValueError("File format not supported when resampling: " + filename)
+    file, and the loader will resample from that rate to 40 MHz (see
+    LoadResampled). Any sample rate specified by the source file's metadata
+    will be ignored, as some formats can't represent typical RF sample rates
+    accurately.
+
+    input_format (i.e. "u8") overrides the file extension, which is needed to
+    read from stdin ("-").  Stdin and FIFOs use loaders that read through
+    infile (see open_input), as they can't be memory mapped or passed to
+    ld-ldf-reader."""
+
+    if inputfreq is not None and inputfreq != 40:
+        loader = make_loader(filename, input_format=input_format)
+        return LoadResampled(loader, inputfreq)
+
+    fmt = filename if input_format is None else "." + input_format.lstrip(".")
+
+    if is_stream(filename):
+        if fmt.endswith(".r30"):
+            return load_packed_data_3_32
+        elif fmt.endswith(".rf"):
+            return load_unpacked_data_float32
+        elif fmt.endswith(".s16"):
+            return load_unpacked_data_s16
+        elif fmt.endswith(".r16") or fmt.endswith(".u16"):
+            return load_unpacked_data_u16
+        elif fmt.endswith(".r8") or fmt.endswith(".u8"):
+            return load_unpacked_data_u8
+        elif fmt.endswith("raw.oga") or fmt.endswith(".ldf") or fmt.endswith(".wav") or fmt.endswith(".flac") or fmt.endswith(".vhs"):
+            # ffmpeg reads the pipe directly
+            return LoadFFmpeg()
         else:
-            # Assume ffmpeg will recognise this format itself.
-            input_args = []
+            return load_packed_data_4_40
 
-        # Use asetrate first to override the input file's sample rate.
-        output_args = [
-            "-filter:a",
-            "asetrate=" + str(inputfreq * 1e6) + ",aresample=" + str(40e6),
-        ]
-
-        return LoadFFmpeg(input_args=input_args, output_args=output_args)
-
-    elif filename.endswith(".lds"):
+    if fmt.endswith(".lds"):
         return load_packed_data_4_40
-    elif filename.endswith(".r30"):
+    elif fmt.endswith(".r30"):
         return load_packed_data_3_32
-    elif filename.endswith(".rf"):
-        return load_unpacked_data_float32
-    elif filename.endswith(".s16"):
-        return load_unpacked_data_s16
-    elif filename.endswith(".r16") or filename.endswith(".u16"):
-        return load_unpacked_data_u16
-    elif filename.endswith(".r8") or filename.endswith(".u8"):
-        return load_unpacked_data_u8
-    elif filename.endswith("raw.oga") or filename.endswith(".ldf") or filename.endswith(".wav") or filename.endswith(".flac") or filename.endswith(".vhs"):
+    elif fmt.endswith(".rf"):
+        return LoadMemmap(filename, "<f4", scale=32768)
+    elif fmt.endswith(".s16"):
+        return LoadMemmap(filename, "<i2")
+    elif fmt.endswith(".r16") or fmt.endswith(".u16"):
+        return LoadMemmap(filename, "<u2")
+    elif fmt.endswith(".r8") or fmt.endswith(".u8"):
+        return LoadMemmap(filename, "u1")
+    elif fmt.endswith("raw.oga") or fmt.endswith(".ldf") or fmt.endswith(".wav") or fmt.endswith(".flac") or fmt.endswith(".vhs"):
         try:
             rv = LoadLDF(filename)
         except:
@@ -196,34 +202,80 @@ def load_unpacked_data_float32(infile, sample, readlen):
     return load_unpacked_data(infile, sample, readlen, 4)
 
 
+class LoadMemmap:
+    """Load samples from an uncompressed file by memory-mapping it.
+
+    Returned arrays are read-only views into the mapping, so no data is
+    copied unless a scale factor is applied (i.e. for float32 .rf files)."""
+
+    def __init__(self, filename, dtype, scale=None):
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self.scale = scale
+
+        # Mapped lazily, and remapped if a read goes past the end in case the
+        # file has grown since (i.e. a capture that is still being written)
+        self.data = None
+
+    def _map(self):
+        length = os.path.getsize(self.filename) // self.dtype.itemsize
+
+        if length == 0:
+            self.data = np.zeros(0, dtype=self.dtype)
+        else:
+            self.data = np.memmap(
+                self.filename, dtype=self.dtype, mode="r", shape=(length,)
+            ).view(np.ndarray)
+
+    def read(self, infile, sample, readlen):
+        if self.data is None or (sample + readlen) > len(self.data):
+            self._map()
+
+        if sample < 0 or (sample + readlen) > len(self.data):
+            return None
+
+        indata = self.data[sample : sample + readlen]
+
+        if self.scale is not None:
+            return indata * self.scale
+
+        return indata
+
+    def __call__(self, infile, sample, readlen):
+        return self.read(infile, sample, readlen)
+
+
 # This is for the .r30 format I did in ddpack/unpack.c.  Depricated but I still have samples in it.
-def load_packed_data_3_32(infile, sample, readlen):
+@njit(cache=True, nogil=True)
+def unpack_data_3_32(indata, offset, out):
+    """Unpack three 10-bit samples per 32-bit word from indata into out,
+    starting at sample offset within the first word."""
+    for i in range(len(out)):
+        j = i + offset
+        out[i] = (indata[j // 3] >> (10 * (j % 3))) & 0x3FF
+
+
+def load_packed_data_3_32(infile, sample, readlen, out=None):
     start = (sample // 3) * 4
     offset = sample % 3
-    start, offset
 
     infile.seek(start)
 
     # we need another word in case offset != 0
-    needed = int(np.ceil(readlen * 3 / 4) * 4) + 4
+    needed = (offset + readlen + 2) // 3
 
-    inbuf = infile.read(needed)
-    indata = np.fromstring(inbuf, "uint32", len(inbuf) // 4)
+    inbuf = infile.read(needed * 4)
+    indata = np.frombuffer(inbuf, "<u4", len(inbuf) // 4)
 
     if len(indata) < needed:
         return None
 
-    unpacked = np.zeros(len(indata) * 3, dtype=np.int16)
+    if out is None:
+        out = np.empty(readlen, dtype=np.int16)
 
-    # By using strides the unpacked data can be loaded with no additional copies
-    np.bitwise_and(indata, 0x3FF, out=unpacked[0::3])
-    # hold the shifted bits in it's own array to avoid an allocation
-    tmp = np.right_shift(indata, 10)
-    np.bitwise_and(tmp, 0x3FF, out=unpacked[1::3])
-    np.right_shift(indata, 20, out=tmp)
-    np.bitwise_and(tmp, 0x3FF, out=unpacked[2::3])
+    unpack_data_3_32(indata, offset, out[:readlen])
 
-    return unpacked[offset : offset + readlen]
+    return out[:readlen]
 
 
 # The 10-bit samples from the Duplicator...
@@ -243,9 +295,34 @@ From Simon's code:
 // 4: 3333 3333
 """
 
-# The bit twiddling is a bit more complex than I'd like... but eh.  I think
-# it's debugged now. ;)
-def load_packed_data_4_40(infile, sample, readlen):
+
+@njit(cache=True, nogil=True)
+def unpack_data_4_40(indata, offset, out):
+    """Unpack four 10-bit samples per five bytes from indata into out, starting
+    at sample offset within the first group.
+
+    Output is converted back to the original DdD 16-bit format (signed 16-bit,
+    left shifted) in the same pass."""
+    for i in range(len(out)):
+        j = i + offset
+        b = (j // 4) * 5
+        p = j % 4
+
+        if p == 0:
+            v = (np.int32(indata[b]) << 2) | (indata[b + 1] >> 6)
+        elif p == 1:
+            v = (np.int32(indata[b + 1] & 0x3F) << 4) | (indata[b + 2] >> 4)
+        elif p == 2:
+            v = (np.int32(indata[b + 2] & 0x0F) << 6) | (indata[b + 3] >> 2)
+        else:
+            v = (np.int32(indata[b + 3] & 0x03) << 8) | indata[b + 4]
+
+        out[i] = (v - 512) << 6
+
+
+def load_packed_data_4_40(infile, sample, readlen, out=None):
+    """Load readlen samples from a .lds file.  If out (an int16 array) is given,
+    the samples are unpacked directly into it."""
     start = (sample // 4) * 5
     offset = sample % 4
 
@@ -260,82 +337,347 @@ def load_packed_data_4_40(infile, sample, readlen):
     if len(indata) < needed:
         return None
 
-    rot2 = np.right_shift(indata, 2)
+    if out is None:
+        out = np.empty(readlen, dtype=np.int16)
 
-    unpacked = np.zeros(readlen + 4, dtype=np.uint16)
+    unpack_data_4_40(indata, offset, out[:readlen])
 
-    # we need to load the 8-bit data into the 16-bit unpacked for left_shift to work
-    # correctly...
-    unpacked[0::4] = indata[0::5]
-    np.left_shift(unpacked[0::4], 2, out=unpacked[0::4])
-    np.bitwise_or(
-        unpacked[0::4],
-        np.bitwise_and(np.right_shift(indata[1::5], 6), 0x03),
-        out=unpacked[0::4],
-    )
+    return out[:readlen]
 
-    unpacked[1::4] = np.bitwise_and(indata[1::5], 0x3F)
-    np.left_shift(unpacked[1::4], 4, out=unpacked[1::4])
-    np.bitwise_or(
-        unpacked[1::4],
-        np.bitwise_and(np.right_shift(indata[2::5], 4), 0x0F),
-        out=unpacked[1::4],
-    )
 
-    unpacked[2::4] = np.bitwise_and(indata[2::5], 0x0F)
-    np.left_shift(unpacked[2::4], 6, out=unpacked[2::4])
-    np.bitwise_or(
-        unpacked[2::4],
-        np.bitwise_and(np.right_shift(indata[3::5], 2), 0x3F),
-        out=unpacked[2::4],
-    )
+def load_blocks(loader, infile, sample, blocklen, step, count):
+    """Load count blocks of blocklen samples, each starting step samples after
+    the previous one, using a single loader call.
+
+    Overlapping areas between blocks are only read (and unpacked) once.
+    Returns a list of read-only views into one buffer, or None if not enough
+    data is available."""
+    total = ((count - 1) * step) + blocklen
+
+    data = loader(infile, sample, total)
+    if data is None or len(data) < total:
+        return None
+
+    # The blocks share memory, so make sure none of them can be altered
+    data.flags.writeable = False
+
+    return [data[i * step : (i * step) + blocklen] for i in range(count)]
+
+
+# Where an array packed into a SharedSlots slot is, and how to rebuild it
+SlotArray = namedtuple("SlotArray", ["offset", "dtype", "shape", "type"])
+
+
+class SharedSlots:
+    """A multiprocessing.shared_memory block split into count fixed-size slots,
+    used to pass arrays to and from worker processes without pickling them.
+
+    pack() copies the arrays in a dict/tuple/list into a slot and returns the
+    same structure with SlotArray descriptors in their place, which is all that
+    needs to go through a queue.  unpack() reverses that.  Workers must be
+    forked after this is created so that they share the mapping, and only the
+    creating process should call alloc()/release()."""
+
+    def __init__(self, count, slotsize):
+        self.count = count
+        self.slotsize = -(-slotsize // 64) * 64
+
+        self.shm = shared_memory.SharedMemory(create=True, size=count * self.slotsize)
+        self.buf = np.frombuffer(self.shm.buf, dtype=np.uint8)
+
+        self.free = list(range(count))
+
+    def alloc(self):
+        """Return a free slot number, or None if they are all in use."""
+        return self.free.pop() if len(self.free) else None
+
+    def release(self, slot):
+        self.free.append(slot)
+
+    def pack(self, slot, item, offset=0):
+        """Copy the arrays in item into slot, starting at byte offset.  Returns
+        (packed item, offset past the last array).  Arrays that don't fit are
+        left in place, so they will be pickled as usual."""
+        if isinstance(item, dict):
+            rv = {}
+            for k, v in item.items():
+                rv[k], offset = self.pack(slot, v, offset)
+            return rv, offset
+        elif isinstance(item, (tuple, list)):
+            rv = []
+            for v in item:
+                packed, offset = self.pack(slot, v, offset)
+                rv.append(packed)
+            return type(item)(rv), offset
+        elif not isinstance(item, np.ndarray) or item.dtype.hasobject:
+            return item, offset
 
-    unpacked[3::4] = np.bitwise_and(indata[3::5], 0x03)
-    np.left_shift(unpacked[3::4], 8, out=unpacked[3::4])
-    np.bitwise_or(unpacked[3::4], indata[4::5], out=unpacked[3::4])
+        if offset + item.nbytes > self.slotsize:
+            return item, offset
 
-    # convert back to original DdD 16-bit format (signed 16-bit, left shifted)
-    rv_unsigned = unpacked[offset : offset + readlen].copy()
-    rv_signed = np.left_shift(rv_unsigned.astype(np.int16) - 512, 6)
+        begin = (slot * self.slotsize) + offset
+        dest = self.buf[begin : begin + item.nbytes].view(item.dtype).reshape(item.shape)
+        dest[...] = item
+
+        packed = SlotArray(offset, item.dtype, item.shape, type(item))
+        return packed, offset + (-(-item.nbytes // 64) * 64)
+
+    def unpack(self, slot, packed, copy=True):
+        """Rebuild an item from pack().  If copy is False the arrays are views
+        into the slot, which are only valid until it is reused."""
+        if isinstance(packed, SlotArray):
+            begin = (slot * self.slotsize) + packed.offset
+            nbytes = int(np.prod(packed.shape)) * packed.dtype.itemsize
+
+            rv = self.buf[begin : begin + nbytes].view(packed.dtype).reshape(packed.shape)
+            if copy:
+                rv = rv.copy()
+
+            return rv if packed.type is np.ndarray else rv.view(packed.type)
+        elif isinstance(packed, dict):
+            return {k: self.unpack(slot, v, copy) for k, v in packed.items()}
+        elif isinstance(packed, (tuple, list)):
+            return type(packed)(self.unpack(slot, v, copy) for v in packed)
+
+        return packed
+
+    def close(self):
+        self.buf = None
+        try:
+            self.shm.close()
+            self.shm.unlink()
+        except (BufferError, OSError):
+            # Still in use (i.e. by a view that hasn't been freed yet)
+            pass
+
+
+class PipeReader:
+    """Read a subprocess pipe into a preallocated ring buffer.
+
+    A background thread keeps the pipe drained, staying up to readahead_size
+    bytes ahead of the last position read.  The rewind_size bytes before that
+    position are kept, so that small backwards seeks can be served without
+    restarting the subprocess."""
+
+    def __init__(
+        self,
+        pipe,
+        position=0,
+        rewind_size=2 * 1024 * 1024,
+        readahead_size=4 * 1024 * 1024,
+        chunk_size=256 * 1024,
+    ):
+        self.pipe = pipe
+        self.rewind_size = rewind_size
+        self.readahead_size = readahead_size
+        self.chunk_size = chunk_size
+
+        self.buf = np.empty(rewind_size + readahead_size, dtype=np.uint8)
+
+        # Absolute byte positions: the oldest byte still in the buffer, the
+        # next byte that will come from the pipe, and the last position read.
+        self.start = position
+        self.end = position
+        self.position = position
+
+        self.eof = False
+        self.closed = False
+
+        self.cond = threading.Condition()
+
+        self.thread = threading.Thread(target=self._fill, daemon=True)
+        self.thread.start()
+
+    def _fill(self):
+        """Background thread: read from the pipe whenever there's room."""
+        view = memoryview(self.buf)
+        buflen = len(self.buf)
+
+        # Return as soon as any data is available, rather than waiting for a
+        # full chunk
+        readinto = getattr(self.pipe, "readinto1", self.pipe.readinto)
+
+        while True:
+            with self.cond:
+                while (
+                    not self.closed and (self.end - self.position) >= self.readahead_size
+                ):
+                    self.cond.wait()
+
+                if self.closed:
+                    return
+
+                offset = self.end % buflen
+                count = min(self.chunk_size, buflen - offset)
+
+                # The oldest data is about to be overwritten
+                self.start = max(self.start, self.end + count - buflen)
+
+            try:
+                nread = readinto(view[offset : offset + count])
+            except (OSError, ValueError):
+                # The pipe was closed from under us
+                nread = 0
+
+            with self.cond:
+                if not nread:
+                    self.eof = True
+                    self.cond.notify_all()
+                    return
+
+                self.end += nread
+                self.cond.notify_all()
+
+    def read(self, position, count, out=None):
+        """Return count bytes starting at position as a numpy uint8 array, or
+        fewer at EOF.  Returns None if position is no longer buffered."""
+
+        with self.cond:
+            if position < self.start:
+                return None
+
+            if out is None:
+                out = np.empty(count, dtype=np.uint8)
+
+            buflen = len(self.buf)
+            done = 0
+
+            # Copy out in pieces, so reads larger than the buffer still work
+            while done < count:
+                cur = position + done
+
+                # Moving the position forward lets the fill thread discard data
+                self.position = max(self.position, cur)
+                self.cond.notify_all()
+
+                while not self.eof and self.end <= cur:
+                    self.cond.wait()
+
+                available = min(count - done, self.end - cur)
+                if available <= 0:
+                    break
+
+                offset = cur % buflen
+                chunk = min(available, buflen - offset)
+                out[done : done + chunk] = self.buf[offset : offset + chunk]
+                done += chunk
+
+            self.position = max(self.position, position + done)
+            self.cond.notify_all()
+
+        return out[:done]
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class StreamFile:
+    """A file-like object for stdin or a FIFO, which can only be read forwards.
+
+    Data is read through a PipeReader, so the loaders that seek and read infile
+    can still re-read the last rewind_size bytes, which covers the field re-reads
+    LDdecode does.  Seeking forwards reads and discards data.
+
+    The pipe isn't read until the first read() call, so its file descriptor can
+    be handed to ffmpeg (see LoadFFmpeg) instead."""
+
+    def __init__(
+        self, pipe, rewind_size=16 * 1024 * 1024, readahead_size=64 * 1024 * 1024
+    ):
+        self.pipe = pipe
+        self.rewind_size = rewind_size
+        self.readahead_size = readahead_size
+
+        self.reader = None
+        self.pos = 0
+
+    def fileno(self):
+        return self.pipe.fileno()
+
+    def seekable(self):
+        return False
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self.pos
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("can't seek from the end of a stream")
+
+        self.pos = pos
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, count):
+        if self.reader is None:
+            self.reader = PipeReader(
+                self.pipe,
+                rewind_size=self.rewind_size,
+                readahead_size=self.readahead_size,
+            )
+
+        data = self.reader.read(self.pos, count)
+        if data is None:
+            raise IOError(
+                "Input stream position %d is no longer buffered (oldest is %d)"
+                % (self.pos, self.reader.start)
+            )
 
-    return rv_signed
+        self.pos += len(data)
+        return data.tobytes()
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+
+        self.pipe.close()
+
+
+def is_stream(filename):
+    """Return True if filename is "-" (stdin) or a FIFO."""
+    if filename == "-":
+        return True
+
+    try:
+        return stat.S_ISFIFO(os.stat(filename).st_mode)
+    except OSError:
+        return False
+
+
+def open_input(filename):
+    """Open filename for reading by a loader.  "-" means stdin.  Streams are
+    wrapped in a StreamFile."""
+    if filename == "-":
+        return StreamFile(sys.stdin.buffer)
+    elif is_stream(filename):
+        return StreamFile(open(filename, "rb", buffering=0))
+
+    return open(filename, "rb")
 
 
 class LoadFFmpeg:
     """Load samples from a wide variety of formats using ffmpeg."""
 
-    def __init__(self, input_args=[], output_args=[]):
+    def __init__(self, input_args=[], output_args=[], rewind_size=2 * 1024 * 1024):
         self.input_args = input_args
         self.output_args = output_args
 
         # ffmpeg subprocess
         self.ffmpeg = None
-
-        # The number of the next byte ffmpeg will return
-        self.position = 0
+        self.reader = None
 
         # Keep a buffer of recently-read data, to allow seeking backwards by
-        # small amounts. The last byte returned by ffmpeg is at the end of
-        # this buffer.
-        self.rewind_size = 2 * 1024 * 1024
-        self.rewind_buf = b""
+        # small amounts.
+        self.rewind_size = rewind_size
 
     def __del__(self):
         if self.ffmpeg is not None:
             self.ffmpeg.kill()
             self.ffmpeg.wait()
-
-    def _read_data(self, count):
-        """Read data as bytes from ffmpeg, append it to the rewind buffer, and
-        return it. May return less than count bytes if EOF is reached."""
-
-        data = self.ffmpeg.stdout.read(count)
-        self.position += len(data)
-
-        self.rewind_buf += data
-        self.rewind_buf = self.rewind_buf[-self.rewind_size :]
-
-        return data
+            self.reader.close()
 
     def read(self, infile, sample, readlen):
         sample_bytes = sample * 2
@@ -350,79 +692,146 @@ class LoadFFmpeg:
             self.ffmpeg = subprocess.Popen(
                 command, stdin=infile, stdout=subprocess.PIPE
             )
+            self.reader = PipeReader(self.ffmpeg.stdout, rewind_size=self.rewind_size)
 
-        if sample_bytes < self.position:
-            # Seeking backwards - use data from rewind_buf
-            start = len(self.rewind_buf) - (self.position - sample_bytes)
-            end = min(start + readlen_bytes, len(self.rewind_buf))
-            if start < 0:
-                raise IOError("Seeking too far backwards with ffmpeg")
-            buf_data = self.rewind_buf[start:end]
-            sample_bytes += len(buf_data)
-            readlen_bytes -= len(buf_data)
-        else:
-            buf_data = b""
-
-        while sample_bytes > self.position:
-            # Seeking forwards - read and discard samples
-            count = min(sample_bytes - self.position, self.rewind_size)
-            self._read_data(count)
-
-        if readlen_bytes > 0:
-            # Read some new data from ffmpeg
-            read_data = self._read_data(readlen_bytes)
-            if len(read_data) < readlen_bytes:
-                # Short read - end of file
-                return None
-        else:
-            read_data = b""
+        data = self.reader.read(sample_bytes, readlen_bytes)
+        if data is None:
+            raise IOError("Seeking too far backwards with ffmpeg")
+
+        if len(data) < readlen_bytes:
+            # Short read - end of file
+            return None
 
-        data = buf_data + read_data
-        assert len(data) == readlen * 2
-        return np.fromstring(data, "<i2")
+        return data.view("<i2")
 
     def __call__(self, infile, sample, readlen):
         return self.read(infile, sample, readlen)
 
 
+def build_ogg_index(filename, interval=1 << 20):
+    """Scan the Ogg pages of filename (i.e. an .ldf file) and return an array of
+    (first sample, byte offset) rows for pages that begin with a new packet,
+    spaced at least interval samples apart.
+
+    Only page headers are read.  Returns None if filename isn't an Ogg file."""
+
+    entries = []
+
+    with open(filename, "rb") as fp:
+        if fp.read(4) != b"OggS":
+            return None
+
+        mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        offset = 0
+        # The number of samples in all the pages before this one
+        page_sample = 0
+        last_entry = -interval
+
+        while offset + 27 <= len(mm):
+            if mm[offset : offset + 4] != b"OggS":
+                # Lost sync (i.e. a damaged file), so look for the next page
+                offset = mm.find(b"OggS", offset + 1)
+                if offset < 0:
+                    break
+                continue
+
+            header_type = mm[offset + 5]
+            granule = int.from_bytes(mm[offset + 6 : offset + 14], "little", signed=True)
+            nsegs = mm[offset + 26]
+
+            if offset + 27 + nsegs > len(mm):
+                break
+
+            # Pages with bit 0 set continue a packet from the previous page
+            if (
+                not (header_type & 0x01)
+                and page_sample > 0
+                and (page_sample - last_entry) >= interval
+            ):
+                entries.append((page_sample, offset))
+                last_entry = page_sample
+
+            # The granule position is -1 when no packet finishes on this page
+            if granule >= 0:
+                page_sample = granule
+
+            offset += 27 + nsegs + sum(mm[offset + 27 : offset + 27 + nsegs])
+    finally:
+        mm.close()
+
+    return np.array(entries, dtype=np.int64).reshape(-1, 2)
+
+
+def load_ogg_index(filename):
+    """Return the seek index for an Ogg file, from its .idx sidecar if that is
+    up to date.  Otherwise the index is built, and saved if possible."""
+
+    idxname = filename + ".idx"
+    st = os.stat(filename)
+    filesize, mtime = st.st_size, st.st_mtime_ns
+
+    try:
+        with np.load(idxname) as idx:
+            if int(idx["filesize"]) == filesize and int(idx["mtime"]) == mtime:
+                return idx["pages"]
+    except (OSError, KeyError, ValueError):
+        pass
+
+    pages = build_ogg_index(filename)
+    if pages is None:
+        return None
+
+    try:
+        with open(idxname, "wb") as fp:
+            np.savez(fp, filesize=filesize, mtime=mtime, pages=pages)
+    except OSError:
+        # Not being able to write the sidecar (i.e. read-only media) is fine
+        pass
+
+    return pages
+
+
 class LoadLDF:
-    """Load samples from an .ldf file, using ld-ldf-reader which itself uses ffmpeg."""
+    """Load samples from an .ldf file, using ld-ldf-reader which itself uses ffmpeg.
+
+    If an Ogg page index is available (see load_ogg_index), ld-ldf-reader is
+    started at the nearest indexed page instead of decoding from the beginning."""
 
-    def __init__(self, filename, input_args=[], output_args=[]):
+    def __init__(
+        self, filename, input_args=[], output_args=[], rewind_size=2 * 1024 * 1024
+    ):
         self.input_args = input_args
         self.output_args = output_args
 
         self.filename = filename
 
-        # The number of the next byte ld-ldf-reader will return
-
-        self.position = 0
         # Keep a buffer of recently-read data, to allow seeking backwards by
-        # small amounts. The last byte returned by ffmpeg is at the end of
-        # this buffer.
-        self.rewind_size = 2 * 1024 * 1024
-        self.rewind_buf = b""
+        # small amounts.
+        self.rewind_size = rewind_size
+
+        try:
+            self.index = load_ogg_index(filename)
+        except OSError:
+            self.index = None
+
+        if self.index is not None and len(self.index) == 0:
+            self.index = None
+
+        # Forward seeks further than this (in bytes) restart ld-ldf-reader instead
+        # of reading and discarding data.  With an index restarting is cheap.
+        self.seek_threshold = 40000000 if self.index is None else self.rewind_size * 4
 
         self.ldfreader = None
+        self.reader = None
 
         # ld-ldf-reader subprocess
-        self.ldfreader = self._open(0)
+        self._open(0)
 
     def __del__(self):
         self._close()
 
-    def _read_data(self, count):
-        """Read data as bytes from ffmpeg, append it to the rewind buffer, and
-        return it. May return less than count bytes if EOF is reached."""
-
-        data = self.ldfreader.stdout.read(count)
-        self.position += len(data)
-
-        self.rewind_buf += data
-        self.rewind_buf = self.rewind_buf[-self.rewind_size :]
-
-        return data
-
     def _close(self):
         try:
             if self.ldfreader is not None:
@@ -430,7 +839,11 @@ class LoadLDF:
                 self.ldfreader.wait()
                 del self.ldfreader
 
+            if self.reader is not None:
+                self.reader.close()
+
             self.ldfreader = None
+            self.reader = None
         except:
             pass
 
@@ -439,56 +852,104 @@ class LoadLDF:
 
         command = ["ld-ldf-reader", self.filename, str(sample)]
 
-        ldfreader = subprocess.Popen(
+        if self.index is not None:
+            page = np.searchsorted(self.index[:, 0], sample, side="right") - 1
+            if page >= 0:
+                command += [str(self.index[page, 1]), str(self.index[page, 0])]
+
+        self.ldfreader = subprocess.Popen(
             command, stdout=subprocess.PIPE, stderr=subprocess.PIPE
         )
-        self.position = sample * 2
-        self.rewind_buf = b""
-
-        return ldfreader
+        self.reader = PipeReader(
+            self.ldfreader.stdout, position=sample * 2, rewind_size=self.rewind_size
+        )
 
     def read(self, infile, sample, readlen):
         sample_bytes = sample * 2
         readlen_bytes = readlen * 2
 
-        if self.ldfreader is None or ((sample_bytes - self.position) > 40000000):
-            self.ldfreader = self._open(sample)
-
-        if sample_bytes < self.position:
-            # Seeking backwards - use data from rewind_buf
-            start = len(self.rewind_buf) - (self.position - sample_bytes)
-            end = min(start + readlen_bytes, len(self.rewind_buf))
-            if start < 0:
-                # raise IOError("Seeking too far backwards with ffmpeg")
-                self.ldfreader = self._open(sample)
-                buf_data = b""
-            else:
-                buf_data = self.rewind_buf[start:end]
-                sample_bytes += len(buf_data)
-                readlen_bytes -= len(buf_data)
-        elif (sample_bytes - self.position) > (40 * 1024 * 1024 * 2):
-            self.ldfreader = self._open(sample)
-            buf_data = b""
-        else:
-            buf_data = b""
-
-        while sample_bytes > self.position:
-            # Seeking forwards - read and discard samples
-            count = min(sample_bytes - self.position, self.rewind_size)
-            self._read_data(count)
-
-        if readlen_bytes > 0:
-            # Read some new data from ffmpeg
-            read_data = self._read_data(readlen_bytes)
-            if len(read_data) < readlen_bytes:
-                # Short read - end of file
-                return None
-        else:
-            read_data = b""
+        if (
+            self.ldfreader is None
+            or sample_bytes < self.reader.start
+            or (sample_bytes - self.reader.end) > self.seek_threshold
+        ):
+            self._open(sample)
+
+        data = self.reader.read(sample_bytes, readlen_bytes)
+        if data is None:
+            # Overwritten while waiting, so start again from here
+            self._open(sample)
+            data = self.reader.read(sample_bytes, readlen_bytes)
+
+        if data is None or len(data) < readlen_bytes:
+            # Short read - end of file
+            return None
 
-        data = buf_data + read_data
-        assert len(data) == readlen * 2
-        return np.frombuffer(data, "<i2")
+        return data.view("<i2")
+
+    def __call__(self, infile, sample, readlen):
+        return self.read(infile, sample, readlen)
+
+
+class LoadResampled:
+    """Wrap another loader, resampling its output from inputfreq to outputfreq
+    (both in MHz) with a rational polyphase filter.
+
+    Every block is computed from the source samples it depends on, starting at
+    an input sample that lines up with the filter phase, so the output is the
+    same no matter how reads are split up.  DemodCache uses prepare() to read the
+    source data and does the filtering in finish() in its worker processes."""
+
+    def __init__(self, loader, inputfreq, outputfreq=40, max_denominator=1000):
+        self.loader = loader
+
+        ratio = (Fraction(outputfreq) / Fraction(inputfreq)).limit_denominator(
+            max_denominator
+        )
+        self.up = ratio.numerator
+        self.down = ratio.denominator
+
+        # Same filter as scipy's resample_poly default, computed once
+        half_len = 10 * max(self.up, self.down)
+        self.filter = sps.firwin(
+            (2 * half_len) + 1, 1 / max(self.up, self.down), window=("kaiser", 5.0)
+        ).astype(np.float32)
+
+        # Input samples needed either side of a block
+        self.margin = (half_len // self.up) + 2
+
+    def prepare(self, infile, sample, readlen):
+        """Read the source data needed to produce readlen output samples starting
+        at sample.  Returns None at EOF."""
+        # Start on an input sample that maps exactly onto an output sample
+        start = (((sample * self.down) // self.up) - self.margin) // self.down
+        start *= self.down
+        end = -(-((sample + readlen) * self.down) // self.up) + self.margin
+
+        # Anything before the start of the file is treated as silence
+        readstart = max(start, 0)
+        data = self.loader(infile, readstart, end - readstart)
+        if data is None or len(data) < end - readstart:
+            return None
+
+        source = np.zeros(end - start, dtype=np.float32)
+        source[readstart - start :] = data
+
+        return source, sample - ((start * self.up) // self.down), readlen
+
+    def finish(self, prepared):
+        """Resample data returned by prepare()."""
+        source, offset, readlen = prepared
+
+        output = sps.resample_poly(source, self.up, self.down, window=self.filter)
+        return output[offset : offset + readlen]
+
+    def read(self, infile, sample, readlen):
+        prepared = self.prepare(infile, sample, readlen)
+        if prepared is None:
+            return None
+
+        return self.finish(prepared)
 
     def __call__(self, infile, sample, readlen):
         return self.read(infile, sample, readlen)
@@ -672,6 +1133,42 @@ def unwrap_hilbert(hilbert, freq_hz):
         tdangles2[tdangles2 > tau] -= tau
     return tdangles2 * (freq_hz / tau)
 
+
+@njit(cache=True, nogil=True)
+def fm_discriminate_rows(hilbert, scale, out):
+    """Phase step between each pair of samples in each row of hilbert,
+    wrapped to [0, tau) and multiplied by scale.  The first of each row is 0."""
+    for r in range(hilbert.shape[0]):
+        out[r, 0] = 0
+        for i in range(1, hilbert.shape[1]):
+            # angle(x[n] * conj(x[n - 1]))
+            a = hilbert[r, i]
+            b = hilbert[r, i - 1]
+            step = np.arctan2(
+                a.imag * b.real - a.real * b.imag, a.real * b.real + a.imag * b.imag
+            )
+            if step < 0:
+                step += tau
+            out[r, i] = step * scale
+
+
+def fm_discriminate(hilbert, freq_hz):
+    """FM demodulator for an analytic signal (or rows of them).
+
+    Gives the same result as unwrap_hilbert, but in a single pass.  complex64
+    input is demodulated in float32.
+    """
+    hilbert = np.asarray(hilbert)
+    if hilbert.dtype != np.complex64:
+        hilbert = hilbert.astype(np.complex128, copy=False)
+
+    rows = hilbert.reshape(-1, hilbert.shape[-1])
+    out = np.empty(rows.shape, dtype=rows.real.dtype)
+    fm_discriminate_rows(rows, rows.real.dtype.type(freq_hz / tau), out)
+
+    return out.reshape(hilbert.shape)
+
+
 def fft_determine_slices(center, min_bandwidth, freq_hz, bins_in):
     ''' returns the # of sub-bins needed to get center+/-min_bandwidth.
         The returned lowbin is the first bin (symmetrically) needed to be saved.
@@ -937,10 +1434,10 @@ def lev_to_db(rlev):
     return 20 * np.log10(rlev)
 
 
-# moved from core.py
+# moved from core.py.  Takes a scalar or an array.
 @njit
 def dsa_rescale(infloat):
-    return int(np.round(infloat * 32767 / 150000))
+    return np.round(infloat * 32767 / 150000)
 
 
 # Hotspot subroutines in FieldNTSC's compute_line_bursts function,
@@ -985,6 +1482,113 @@ def write_json(ldd, jsondict, outname):
     os.rename(outname + ".tbc.json.tmp", outname + ".tbc.json")
 
 
+def input_length(loader, infile):
+    """ Return the number of samples loader can read from infile.  This is found
+        by binary search, as compressed formats don't give it directly. """
+    hi = 1
+    while loader(infile, hi - 1, 1) is not None:
+        hi *= 2
+
+    # Sample lo - 1 can be read, and sample hi - 1 can't
+    lo = hi // 2
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if loader(infile, mid - 1, 1) is not None:
+            lo = mid
+        else:
+            hi = mid
+
+    return lo
+
+
+def stitch_chunks(outname, chunknames, starts, bytes_per_field):
+    """ Join the outputs of decoding a capture in chunks into one set of files.
+
+        Each chunk after the first starts decoding before starts[i] to let AGC
+        and MTF settle, so its fields before the first one at or after starts[i]
+        are skipped, and it takes over from the previous chunk with a first
+        field.  Returns the number of fields written.
+    """
+    chunks = []
+    for name in chunknames:
+        with open(name + ".tbc.json", "r") as fp:
+            chunks.append(json.load(fp))
+
+    # The first field used from each chunk
+    firsts = [0]
+    for jsondict, start in zip(chunks[1:], starts[1:]):
+        fields = jsondict["fields"]
+        first = len(fields)
+        for i, fi in enumerate(fields):
+            if fi["fileLoc"] >= start and fi["isFirstField"]:
+                first = i
+                break
+        firsts.append(first)
+
+    # ... and the field after the last one.  A chunk stops at the field the
+    # next one takes over at, which may be decoded at a slightly different
+    # location, and a trailing first field is left for the next chunk.
+    ends = []
+    for i, jsondict in enumerate(chunks):
+        fields = jsondict["fields"]
+        end = len(fields)
+        if i + 1 < len(chunks) and firsts[i + 1] < len(chunks[i + 1]["fields"]):
+            nextloc = chunks[i + 1]["fields"][firsts[i + 1]]["fileLoc"]
+            for j in range(firsts[i], len(fields)):
+                if fields[j]["fileLoc"] >= nextloc - (bytes_per_field // 2):
+                    end = j
+                    break
+            if end > firsts[i] and fields[end - 1]["isFirstField"]:
+                end -= 1
+        ends.append(end)
+
+    vp = chunks[0]["videoParameters"]
+    fieldbytes = vp["fieldWidth"] * vp["fieldHeight"] * 2
+
+    outfields = []
+    outputs = [(".tbc", None), (".pcm", "audioSamples"), (".efm", "efmTValues")]
+    for ext, countkey in outputs:
+        if not os.path.exists(chunknames[0] + ext):
+            continue
+
+        with open(outname + ext, "wb") as fpout:
+            for name, jsondict, first, end in zip(chunknames, chunks, firsts, ends):
+                fields = jsondict["fields"]
+                if countkey is None:
+                    sizes = [fieldbytes] * len(fields)
+                else:
+                    # 16-bit stereo audio, or a byte per EFM T-value
+                    unit = 4 if ext == ".pcm" else 1
+                    sizes = [fi.get(countkey, 0) * unit for fi in fields]
+
+                with open(name + ext, "rb") as fpin:
+                    fpin.seek(sum(sizes[:first]))
+                    remaining = sum(sizes[first:end])
+                    while remaining > 0:
+                        data = fpin.read(min(remaining, 16 * 1024 * 1024))
+                        if not len(data):
+                            break
+                        fpout.write(data)
+                        remaining -= len(data)
+
+    for jsondict, first, end in zip(chunks, firsts, ends):
+        outfields += jsondict["fields"][first:end]
+
+    for i, fi in enumerate(outfields):
+        fi["seqNo"] = i + 1
+
+    jsonout = chunks[0]
+    jsonout["fields"] = outfields
+    jsonout["videoParameters"]["numberOfSequentialFields"] = len(outfields)
+
+    with open(outname + ".tbc.json.tmp", "w") as fp:
+        json.dump(jsonout, fp)
+        fp.write("\n")
+    os.rename(outname + ".tbc.json.tmp", outname + ".tbc.json")
+
+    return len(outfields)
+
+
 def jsondump_thread(ldd, outname):
     """
     This creates a background thread to write a json dict to a file.
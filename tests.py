@@ -1,7 +1,18 @@
+import io
+import json
+import os
+import struct
+import tempfile
+import threading
+import types
 import unittest
 
 import numpy as np
+import scipy.signal as sps
 
+import lddecode.core as ldd
+import lddecode.efm_pll as efm_pll
+import lddecode.utils as lddu
 import vhsdecode.process as process
 import vhsdecode.utils as utils
 
@@ -65,6 +76,434 @@ class DemodTest(unittest.TestCase):
         # so allowing a little more tolerance here.
         np.testing.assert_allclose(min_demod, np.full(len(min_demod), min_hz), atol=50)
 
+    def test_demod_products(self):
+        """Check that only the requested outputs are demodulated, unchanged."""
+        decoder = ldd.RFDecode(system="PAL")
+        wave = utils.gen_wave_at_frequency(8.5, 40, decoder.blocklen)
+        full = decoder.demodblock(data=wave, cut=True)
+
+        rv = decoder.demodblock(data=wave, cut=True, products={"demod_pilot"})
+        self.assertEqual(rv["video"].dtype.names, ("demod", "demod_pilot"))
+        self.assertNotIn("rfhpf", rv)
+        for name in rv["video"].dtype.names:
+            np.testing.assert_array_equal(rv["video"][name], full["video"][name])
+
+    def test_demod_batch(self):
+        """Check that demodulating blocks as a batch matches doing each alone."""
+        decoder = ldd.RFDecode(system="NTSC", decode_digital_audio=True)
+        rng = np.random.default_rng(0)
+        fftdata = decoder.blockfft(rng.normal(0, 8192, (3, decoder.blocklen)))
+
+        batch = decoder.demodblocks(fftdata.copy(), mtf_level=0.5, cut=True)
+        for i, rv in enumerate(batch):
+            single = decoder.demodblock(fftdata=fftdata[i], mtf_level=0.5, cut=True)
+            np.testing.assert_allclose(rv["video"]["demod"], single["video"]["demod"])
+            np.testing.assert_array_equal(rv["efm"], single["efm"])
+
+    def test_demod_cache_serial(self):
+        """Check that a serial decode reads a warm disk cache back unchanged."""
+        decoder = ldd.RFDecode(system="NTSC")
+        rng = np.random.default_rng(0)
+        samples = rng.normal(0, 8192, decoder.blocklen * 4).astype(np.int16)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "test.s16")
+            samples.tofile(filename)
+
+            outputs = []
+            for run in range(2):
+                with open(filename, "rb") as infile:
+                    cache = ldd.DemodCache(
+                        decoder,
+                        infile,
+                        lddu.load_unpacked_data_s16,
+                        demod_cache=os.path.join(tmpdir, "cache"),
+                        backend="serial",
+                    )
+                    # Read past the first block a few times, so adapt() runs
+                    outputs.append(
+                        [
+                            cache.read(start, decoder.blocklen)["video"]["demod"]
+                            for start in range(0, decoder.blocklen * 2, 1000)
+                        ]
+                    )
+                    stats = dict(cache.stats)
+                    cache.end()
+
+            self.assertEqual(stats["blocks"], 0)
+            self.assertGreater(stats["diskblocks"], 0)
+            # The disk cache keeps float32 records
+            for first, second in zip(*outputs):
+                np.testing.assert_array_equal(first.astype(np.float32), second)
+
+    def test_demod_cache_products(self):
+        """Check that products outside demod_products are added on demand."""
+        decoder = ldd.RFDecode(system="PAL")
+        decoder.demod_products = {"demod"}
+        rng = np.random.default_rng(0)
+        samples = rng.normal(0, 8192, decoder.blocklen * 4).astype(np.int16)
+
+        def loader(infile, sample, readlen):
+            data = samples[sample : sample + readlen]
+            return data if len(data) == readlen else None
+
+        cache = ldd.DemodCache(decoder, None, loader, backend="serial")
+        try:
+            rv = cache.read(0, 1000)
+            self.assertEqual(rv["video"].dtype.names, ("demod",))
+            blocks = cache.stats["blocks"]
+
+            rv2 = cache.read(0, 1000, products={"demod_05", "rfhpf"})
+            self.assertEqual(rv2["video"].dtype.names, ("demod", "demod_05"))
+            # The cached output is added to, not demodulated again
+            self.assertEqual(cache.stats["blocks"], blocks)
+            np.testing.assert_array_equal(rv2["video"]["demod"], rv["video"]["demod"])
+
+            expected = decoder.demodblock(
+                data=samples[: decoder.blocklen],
+                cut=True,
+                products={"demod_05", "rfhpf"},
+            )
+            np.testing.assert_array_equal(
+                rv2["video"]["demod_05"], expected["video"]["demod_05"]
+            )
+            np.testing.assert_array_equal(rv2["rfhpf"], expected["rfhpf"])
+
+            with self.assertRaises(ValueError):
+                cache.read(0, 1000, products={"demod_bogus"})
+        finally:
+            cache.end()
+
+    def test_demod_cache_loader_error(self):
+        """Check that an exception from the loader reaches read() instead of
+        leaving it waiting for the reader thread."""
+        decoder = ldd.RFDecode(system="NTSC")
+        rng = np.random.default_rng(0)
+        samples = rng.normal(0, 8192, decoder.blocklen * 8).astype(np.int16)
+
+        def loader(infile, sample, readlen):
+            if sample + readlen > decoder.blocklen * 4:
+                raise IOError("Read error")
+            return samples[sample : sample + readlen]
+
+        for backend in ["serial", "thread"]:
+            cache = ldd.DemodCache(decoder, None, loader, backend=backend)
+            try:
+                cache.read(0, 1000)
+                with self.assertRaises(IOError):
+                    cache.read(decoder.blocklen * 5, 1000)
+            finally:
+                cache.end()
+
+    def test_fm_discriminate(self):
+        """Check that the single-pass FM demodulator matches unwrap_hilbert."""
+        rng = np.random.default_rng(0)
+        t = np.arange(32768)
+        phase = 2 * np.pi * (8.5 / 40) * t + 3 * np.sin(t / 40)
+        hilbert = np.exp(1j * phase) * rng.normal(1, 0.3, len(t))
+        hilbert += rng.normal(0, 0.2, len(t)) + 1j * rng.normal(0, 0.2, len(t))
+
+        expected = lddu.unwrap_hilbert(hilbert, 40e6)
+        demod = lddu.fm_discriminate(hilbert, 40e6)
+        np.testing.assert_allclose(demod, expected, atol=1e-3)
+
+        rows = lddu.fm_discriminate(np.stack([hilbert, hilbert[::-1]]), 40e6)
+        np.testing.assert_allclose(rows[0], expected, atol=1e-3)
+
+        single = lddu.fm_discriminate(hilbert.astype(np.complex64), 40e6)
+        self.assertEqual(single.dtype, np.float32)
+        np.testing.assert_allclose(single, expected, atol=10)
+
+
+class EFMTest(unittest.TestCase):
+    def test_pll(self):
+        """Check that the PLL recovers T values, however the input is split."""
+        rng = np.random.default_rng(0)
+        runs = rng.integers(3, 12, 2000)
+        edges = np.cumsum(runs * efm_pll.basePeriod)
+        level = np.searchsorted(edges, np.arange(int(edges[-1]))) % 2
+        data = np.int16(level * 20000 - 10000)
+
+        tvalues = efm_pll.EFM_PLL().process(data).copy()
+        # The first run starts before the input does
+        np.testing.assert_array_equal(tvalues[1:], runs[1 : len(tvalues)])
+
+        pll = efm_pll.EFM_PLL()
+        split = [pll.process(data[:5001]).copy(), pll.process(data[5001:])]
+        np.testing.assert_array_equal(np.concatenate(split), tvalues)
+
+
+class AudioTest(unittest.TestCase):
+    def test_downscale_audio(self):
+        """Check that analog audio is averaged per output sample, with TBC
+        jumps masked."""
+        sysparams = {
+            "line_period": 63.5,
+            "audio_lfreq": 2301136,
+            "audio_rfreq": 2812499,
+        }
+        rf = types.SimpleNamespace(SysParams=sysparams, linelen=2540)
+
+        # Lines from 100 on are 2% late, which is more than the disc could drift
+        lineinfo = (np.arange(270) * 2540.0) + 1000
+        lineinfo[100:] += 2540 * 0.02
+
+        length = (270 * 2540) // 64
+        audio = np.rec.array(
+            [
+                np.full(length, sysparams["audio_lfreq"] + 15000.0),
+                np.full(length, sysparams["audio_rfreq"] - 15000.0),
+            ],
+            names=["audio_left", "audio_right"],
+        )
+
+        for freq in [44100, 48000, 96000]:
+            output, offset = ldd.downscale_audio(audio, lineinfo, rf, 263, 0, freq)
+            self.assertAlmostEqual(len(output) / 2, 263 * 63.5e-6 * freq, delta=1)
+            np.testing.assert_array_equal(output[0::2], 3277)
+            np.testing.assert_array_equal(output[1::2], -3277)
+
+    def test_audio_phase2_stream(self):
+        """Check that overlapping reads get the same second phase audio."""
+        rf = ldd.RFDecode(system="NTSC", decode_analog_audio=44.1)
+        blockaudio = 1982
+
+        t = np.arange(blockaudio * 40) / rf.Filters["freq_arf"]
+        rng = np.random.default_rng(0)
+        audio = np.rec.array(
+            [
+                rf.SysParams[freq] + (50000 * np.sin(2 * np.pi * tone * t))
+                + rng.normal(0, 1000, len(t))
+                for freq, tone in [("audio_lfreq", 1000), ("audio_rfreq", 3000)]
+            ],
+            names=["audio_left", "audio_right"],
+        )
+
+        stream = ldd.AudioPhase2(rf, align=blockaudio)
+        first = stream.process(audio[: blockaudio * 30], 0)
+        start = blockaudio * 12
+        second = stream.process(audio[start:], start)
+        self.assertEqual(len(second), len(t[start:]) // 4)
+
+        skip = start // 4
+        for name in ["audio_left", "audio_right"]:
+            np.testing.assert_allclose(
+                second[name][: len(first) - skip], first[name][skip:], rtol=0, atol=0.01
+            )
+
+        # This starts half way between two of the last read's output samples.
+        # Away from its start, filtering it on its own gives the same output.
+        start = blockaudio * 13
+        third = stream.process(audio[start:], start)
+        alone = ldd.AudioPhase2(rf, align=blockaudio).process(audio[start:], start)
+        for name in ["audio_left", "audio_right"]:
+            np.testing.assert_allclose(
+                third[name][512:], alone[name][512:], rtol=0, atol=1
+            )
+
+
+class LoaderTest(unittest.TestCase):
+    def test_packed_4_40(self):
+        """Check that .lds unpacking matches the 10-bit packing layout."""
+        rng = np.random.default_rng(0)
+        samples = rng.integers(0, 1024, 4000, dtype=np.uint16)
+
+        # Pack four 10-bit samples into five bytes, MSB first
+        bits = np.unpackbits(
+            samples.astype(">u2").view(np.uint8).reshape(-1, 2), axis=1
+        )[:, 6:]
+        packed = np.packbits(bits.ravel()).tobytes()
+
+        expected = np.left_shift(samples.astype(np.int16) - 512, 6)
+
+        for start, length in [(0, 1000), (1, 999), (3, 2048)]:
+            data = lddu.load_packed_data_4_40(io.BytesIO(packed), start, length)
+            np.testing.assert_array_equal(data, expected[start : start + length])
+
+        blocks = lddu.load_blocks(
+            lddu.load_packed_data_4_40, io.BytesIO(packed), 2, 1024, 900, 3
+        )
+        np.testing.assert_array_equal(blocks[2], expected[1802 : 1802 + 1024])
+
+    def test_packed_3_32(self):
+        """Check that .r30 unpacking matches the 10-bit packing layout."""
+        rng = np.random.default_rng(0)
+        samples = rng.integers(0, 1024, (1000, 3), dtype=np.uint32)
+        packed = (samples[:, 0] | (samples[:, 1] << 10) | (samples[:, 2] << 20))
+
+        expected = samples.ravel().astype(np.int16)
+
+        for start, length in [(0, 999), (2, 1000)]:
+            data = lddu.load_packed_data_3_32(
+                io.BytesIO(packed.astype("<u4").tobytes()), start, length
+            )
+            np.testing.assert_array_equal(data, expected[start : start + length])
+
+    def test_resampled(self):
+        """Check that resampling gives the same output however reads are split."""
+        rng = np.random.default_rng(0)
+        samples = rng.integers(0, 1024, 40000, dtype=np.uint16)
+
+        def loader(infile, sample, readlen):
+            data = samples[sample : sample + readlen]
+            return data if len(data) == readlen else None
+
+        resampler = lddu.LoadResampled(loader, (8 * 315.0) / 88.0)
+        self.assertEqual((resampler.up, resampler.down), (88, 63))
+
+        expected = sps.resample_poly(
+            samples.astype(np.float32), 88, 63, window=resampler.filter
+        )
+
+        for start, length in [(0, 1000), (1, 999), (12345, 32768)]:
+            data = resampler(None, start, length)
+            np.testing.assert_array_equal(data, expected[start : start + length])
+
+        self.assertIsNone(resampler(None, len(expected) - 100, 1000))
+
+    def test_ogg_index(self):
+        """Check that the Ogg page index points at pages starting new packets."""
+
+        def page(header_type, granule, length):
+            segments = [255] * (length // 255) + [length % 255]
+            header = b"OggS" + bytes([0, header_type]) + struct.pack("<q", granule)
+            header += bytes(12) + bytes([len(segments)]) + bytes(segments)
+            return header + bytes(length)
+
+        # FLAC mapping and comment header pages, then audio pages.  Every third
+        # page continues a packet, and so can't be used as a starting point.
+        data = page(2, 0, 40) + page(0, 0, 60)
+        expected = []
+        for i in range(1, 20):
+            continued = (i % 3) == 0
+            if i > 1 and not continued:
+                expected.append(((i - 1) * 4096, len(data)))
+            data += page(1 if continued else 0, i * 4096, 1000)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "test.ldf")
+            with open(filename, "wb") as fp:
+                fp.write(data)
+
+            np.testing.assert_array_equal(
+                lddu.build_ogg_index(filename, interval=1), expected
+            )
+
+            # The default interval only keeps the first entry for a file this short
+            index = lddu.load_ogg_index(filename)
+            self.assertTrue(os.path.exists(filename + ".idx"))
+            np.testing.assert_array_equal(index, expected[:1])
+
+            # The sidecar is used while the file is unchanged, and rebuilt once
+            # its modification time changes, even at the same size
+            st = os.stat(filename)
+            with open(filename + ".idx", "wb") as fp:
+                np.savez(fp, filesize=st.st_size, mtime=st.st_mtime_ns, pages=[[1, 2]])
+            np.testing.assert_array_equal(lddu.load_ogg_index(filename), [[1, 2]])
+
+            os.utime(filename, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+            np.testing.assert_array_equal(lddu.load_ogg_index(filename), expected[:1])
+
+    def test_stream_rewind(self):
+        """Check that reading a pipe further back than it keeps raises IOError."""
+        decoder = ldd.RFDecode(system="NTSC")
+        rng = np.random.default_rng(0)
+        samples = rng.normal(0, 8192, decoder.blocklen * 16).astype(np.int16)
+
+        rfd, wfd = os.pipe()
+
+        def writer():
+            with os.fdopen(wfd, "wb") as fp:
+                fp.write(samples.tobytes())
+
+        thread = threading.Thread(target=writer, daemon=True)
+        thread.start()
+
+        # Keep about four blocks of input and cached output
+        infile = lddu.StreamFile(
+            os.fdopen(rfd, "rb", buffering=0),
+            rewind_size=decoder.blocklen * 8,
+            readahead_size=decoder.blocklen * 8,
+        )
+        cache = ldd.DemodCache(
+            decoder,
+            infile,
+            lddu.load_unpacked_data_s16,
+            cache_mb=4,
+            readahead=2,
+            backend="serial",
+        )
+        try:
+            for start in range(0, decoder.blocklen * 12, decoder.blocklen // 2):
+                cache.read(start, 1000)
+
+            with self.assertRaisesRegex(IOError, "no longer buffered"):
+                cache.read(0, 1000)
+        finally:
+            cache.end()
+            infile.close()
+            thread.join()
+
+    def test_input_length(self):
+        """Check that the input length is found for any loader."""
+        samples = np.zeros(123457, dtype=np.int16)
+
+        def loader(infile, sample, readlen):
+            data = samples[sample : sample + readlen]
+            return data if len(data) == readlen else None
+
+        self.assertEqual(lddu.input_length(loader, None), len(samples))
+
+
+class ChunkTest(unittest.TestCase):
+    def test_stitch_chunks(self):
+        """Check that chunk outputs are joined at first fields past each start."""
+        field_len = 1000
+        vp = {"fieldWidth": 4, "fieldHeight": 2, "numberOfSequentialFields": 0}
+
+        def write_chunk(name, locs):
+            fields = [
+                {
+                    "seqNo": i + 1,
+                    "isFirstField": (loc // field_len) % 2 == 0,
+                    "fileLoc": loc,
+                    "audioSamples": 2,
+                }
+                for i, loc in enumerate(locs)
+            ]
+            with open(name + ".tbc.json", "w") as fp:
+                json.dump({"videoParameters": vp, "fields": fields}, fp)
+
+            # Each field's data is filled with its location
+            tbc = np.repeat(np.array(locs, dtype=np.uint16) // field_len, 8)
+            tbc.tofile(name + ".tbc")
+            np.repeat(tbc[::8], 4).astype(np.uint16).tofile(name + ".pcm")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            names = [os.path.join(tmpdir, "chunk%d" % i) for i in range(2)]
+            # The second chunk starts with warm-up fields, and at a second field
+            write_chunk(names[0], range(0, 14000, field_len))
+            write_chunk(names[1], range(7003, 20003, field_len))
+
+            outname = os.path.join(tmpdir, "out")
+            count = lddu.stitch_chunks(outname, names, [0, 9000], field_len)
+
+            with open(outname + ".tbc.json", "r") as fp:
+                jsondict = json.load(fp)
+
+            fields = jsondict["fields"]
+            self.assertEqual(count, 20)
+            self.assertEqual([fi["seqNo"] for fi in fields], list(range(1, 21)))
+            self.assertEqual(
+                [fi["isFirstField"] for fi in fields], [True, False] * 10
+            )
+            self.assertEqual(jsondict["videoParameters"]["numberOfSequentialFields"], 20)
+
+            tbc = np.fromfile(outname + ".tbc", dtype=np.uint16)
+            np.testing.assert_array_equal(tbc[::8], np.arange(20))
+            pcm = np.fromfile(outname + ".pcm", dtype=np.uint16)
+            np.testing.assert_array_equal(pcm[::4], np.arange(20))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -9,7 +9,12 @@ CXADC_TENBIT_FREQ_HIGH = 3150.0 / 88.0 / 2.0  # 17.897727272
 
 def common_parser(meta_title):
     parser = argparse.ArgumentParser(description=meta_title)
-    parser.add_argument("infile", metavar="infile", type=str, help="source file")
+    parser.add_argument(
+        "infile",
+        metavar="infile",
+        type=str,
+        help="source file (- or a FIFO to stream)",
+    )
     parser.add_argument(
         "outfile", metavar="outfile", type=str, help="base name for destination files"
     )
@@ -61,6 +66,26 @@ def common_parser(meta_title):
         default=1,
         help="number of CPU threads to use",
     )
+    parser.add_argument(
+        "--cache_mb",
+        metavar="MB",
+        type=int,
+        default=None,
+        help="limit the demodulation cache to about this many MB",
+    )
+    parser.add_argument(
+        "--demod_cache",
+        metavar="DIR",
+        type=str,
+        default=None,
+        help="save demodulated blocks in DIR, and reuse them when decoding the same input again",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["process", "thread", "serial"],
+        default="process",
+        help="demodulate in worker processes (default), worker threads, or serially in the main thread",
+    )
     parser.add_argument(
         "-f",
         "--frequency",
@@ -70,6 +95,13 @@ def common_parser(meta_title):
         default=None,
         help="RF sampling frequency in source file (default is 40MHz)",
     )
+    parser.add_argument(
+        "--input_format",
+        metavar="EXT",
+        type=str,
+        default=None,
+        help="source sample format as a file extension (i.e. u8), for stdin",
+    )
     parser.add_argument(
         "--NTSCJ",
         dest="ntscj",
@@ -209,5 +241,8 @@ def get_rf_options(args):
 def get_extra_options(args):
     extra_options = {
         "useAGC": args.AGC and not args.noAGC,
+        "cache_mb": args.cache_mb,
+        "demod_cache": args.demod_cache,
+        "backend": args.backend,
     }
     return extra_options
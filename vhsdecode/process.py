@@ -8,7 +8,8 @@ from collections import namedtuple
 
 import lddecode.core as ldd
 import lddecode.utils as lddu
-from lddecode.utils import unwrap_hilbert, inrange
+import lddecode.fft_service as npfft
+from lddecode.utils import fm_discriminate, inrange
 import vhsdecode.utils as utils
 from vhsdecode.utils import get_line
 from vhsdecode.utils import StackableMA
@@ -22,16 +23,6 @@ from vhsdecode.addons.chromaAFC import ChromaAFC
 
 from numba import njit
 
-# Use PyFFTW's faster FFT implementation if available
-try:
-    import pyfftw.interfaces.numpy_fft as npfft
-    import pyfftw.interfaces
-
-    pyfftw.interfaces.cache.enable()
-    pyfftw.interfaces.cache.set_keepalive_time(10)
-except ImportError:
-    import numpy.fft as npfft
-
 
 def chroma_to_u16(chroma):
     """Scale the chroma output array to a 16-bit value for output."""
@@ -1410,6 +1401,9 @@ class VHSDecode(ldd.LDdecode):
             self.infile,
             self.freader,
             num_worker_threads=self.numthreads,
+            cache_mb=extra_options.get("cache_mb"),
+            demod_cache=extra_options.get("demod_cache"),
+            backend=extra_options.get("backend", "process"),
         )
 
         if fname_out is not None:
@@ -1540,7 +1534,8 @@ class VHSDecode(ldd.LDdecode):
                         self.rf.SysParams["hz_ire"] = self.rf.AGClevels[1].pull()
 
                 if adjusted == False and redo == True:
-                    self.demodcache.flush_demod()
+                    # Demodulated blocks are cached per MTF level, so this only
+                    # demodulates again if the MTF level has changed
                     adjusted = True
                     self.fdoffset -= offset
                 else:
@@ -1997,6 +1992,13 @@ class VHSRFDecode(ldd.RFDecode):
 
         return result
 
+    def blockfft(self, data):
+        # The filters here are applied to the full spectrum
+        return npfft.fft(data[..., : self.blocklen])
+
+    def demodblocks(self, fftdata, mtf_level=0, cut=False):
+        return [self.demodblock(fftdata=f, mtf_level=mtf_level, cut=cut) for f in fftdata]
+
     def demodblock(self, data=None, mtf_level=0, fftdata=None, cut=False, thread_benchmark=False):
         rv = {}
         demod_start_time = time.time()
@@ -2042,7 +2044,7 @@ class VHSRFDecode(ldd.RFDecode):
         hilbert = npfft.ifft(indata_fft_filt * self.Filters["hilbert"])
 
         # FM demodulator
-        demod = unwrap_hilbert(hilbert, self.freq_hz).real
+        demod = fm_discriminate(hilbert, self.freq_hz)
 
         if self.chroma_trap:
             # applies the Subcarrier trap
@@ -2059,9 +2061,9 @@ class VHSRFDecode(ldd.RFDecode):
             check_value = self.options.diff_demod_check_value
 
             if np.max(demod[20:-20]) > check_value:
-                demod_b = unwrap_hilbert(
+                demod_b = fm_discriminate(
                     np.pad(np.diff(hilbert), (1, 0), mode="constant"), self.freq_hz
-                ).real
+                )
                 demod = replace_spikes(demod, demod_b, check_value)
 
         # applies main deemphasis filter